@@ -1,10 +1,29 @@
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, abort, g, Response
 import json
 from flask_cors import CORS
-
-from models import setup_db, Movie, Actor, Role
-from auth import AuthError, requires_auth
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import setup_db, db, commit, Movie, Actor, Role
+from json_provider import jsonify
+from auth import (AuthError, requires_auth, get_token_auth_header,
+                  verify_decode_jwt_cached, check_permissions, token_cache)
+from metrics import (init_metrics, register_gauge, metrics_token_valid,
+                     render as render_metrics)
+from profiling import init_profiling
+from pagination import page_args, paginate, encode_cursor
+from export import wants_ndjson, ndjson_response
+from queries import MOVIES, ACTORS
+from graph import GRAPH_MAX_DEPTH, costar_graph
+from stats import catalog_stats
+from conditional import conditional, versioned
+from response_cache import cached, response_cache
+from writes import (update_movie_row, update_actor_row, delete_movie_row,
+                    delete_actor_row)
+from batch import BATCH_MAX_OPERATIONS, validate_operation, run_batch
+from bulk import (BULK_MAX_ITEMS, validate_movie, validate_actor,
+                  validate_role, validate_items, create_items,
+                  insert_roles, delete_roles)
 
 
 def create_app(test_config=None):
@@ -18,6 +37,20 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app, dbpath)
     CORS(app)
+    init_metrics(app)
+    init_profiling(app)
+    register_gauge('db_pool_checked_out',
+                   'Connections of the pool in use',
+                   lambda: db.engine.pool.checkedout())
+    register_gauge('response_cache_hit_rate',
+                   'Hit rate of the response cache',
+                   lambda: response_cache.stats()['hit_rate'])
+    register_gauge('token_cache_hit_rate',
+                   'Hit rate of the verified tokens cache',
+                   lambda: token_cache.stats()['hit_rate'])
+    register_gauge('singleflight_waiting',
+                   'Requests waiting for an identical request',
+                   lambda: response_cache.flights.stats()['waiting'])
 
     # CORS Headers
     @app.after_request
@@ -41,80 +74,281 @@ def create_app(test_config=None):
 
     '''
     GET /movies
+        paginated with ?limit= and the opaque ?cursor= returned as
+        next_cursor by the previous page
+        ?fields=id,name,release selects the columns, ?include=actors adds
+        the cast (by default the names of the cast are embedded)
+        ?ids=1,2,3 returns these movies in this order instead of a page,
+        the unknown ids are listed in missing
+        ?q= searches the titles, ?release_from= and ?release_to= (ISO
+        dates, inclusive) filter the release
+        Accept: application/x-ndjson streams all the movies instead
+        conditional: ETag/Last-Modified, 304 if unchanged
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional('movies', 'actors', 'roles')
+    @cached('movies')
     def get_movies(_):
-        movies_all = Movie.query.all()
-        movies = [movie.short() for movie in movies_all]
-        return jsonify({
-            'success': True,
-            'movies': movies
-            }), 200
+        return list_resource(MOVIES, 'movies')
 
     '''
     GET /movies/id
+        the movie and its cast
+        ?fields= and ?include=actors like GET /movies, the response is
+        then {"movies": [movie]}
     '''
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
-    def role_movie(movie_id):
-        movie = Movie.query.get(movie_id)
-        roles_movie = Role.query.join(Actor).filter(
-            Role.movie_id == movie_id).all()
-        actors = [role.actor() for role in roles_movie]
-        return jsonify({
-            'success': True,
-            'movies': movie.title,
-            'actors': actors
-            }), 200
+    @versioned('movies', 'actors', 'roles')
+    @cached('movie:{movie_id}')
+    def role_movie(_, movie_id):
+        return detail_resource(MOVIES, 'movies', movie_id)
 
     '''
     GET /actors
+        paginated with ?limit= and ?cursor= like GET /movies
+        ?fields=id,name,age,gender selects the columns, ?include=movies
+        adds the movies of the actors
+        ?ids=1,2,3 returns these actors in this order like GET /movies
+        ?q= searches the names, ?age_min=, ?age_max= and ?gender= filter
+        the actors
+        Accept: application/x-ndjson streams all the actors instead
+        conditional: ETag/Last-Modified, 304 if unchanged
     '''
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional('actors', includes=('movies', 'roles'))
+    @cached('actors')
     def get_actors(_):
-        actors_all = Actor.query.all()
-        actors = [actor.short() for actor in actors_all]
+        return list_resource(ACTORS, 'actors')
+
+    '''
+    GET /actors/id
+        the actor and the movies in which the actor plays
+        ?fields= and ?include=movies like GET /actors, the response is
+        then {"actors": [actor]}
+    '''
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @versioned('movies', 'actors', 'roles')
+    @cached('actor:{actor_id}')
+    def role_actor(_, actor_id):
+        return detail_resource(ACTORS, 'actors', actor_id)
+
+    def list_resource(resource, key):
+        try:
+            fields, include = resource.parse(request.args)
+            ids = resource.parse_ids(request.args)
+            criteria = resource.criteria(request.args)
+        except ValueError:
+            abort(400)
+        legacy = resource.is_legacy(request.args)
+        if include and key == 'actors':
+            # the movie titles are part of the cached response
+            g.cache_tags.add('movies')
+
+        def serialize(rows):
+            return resource.serialize(rows, fields, include, legacy)
+
+        if ids is not None:
+            items, missing = resource.by_ids(
+                ids, fields, include, legacy, criteria)
+            return jsonify({
+                'success': True,
+                key: items,
+                'missing': missing
+                }), 200
+        if wants_ndjson(request):
+            return ndjson_response(
+                resource.query(fields, criteria).order_by(
+                    resource.fields['id']),
+                serialize)
+        try:
+            limit, last_id = page_args(request.args)
+        except ValueError:
+            abort(400)
+        # the related names of the whole page are read with one query
+        rows, next_cursor = paginate(resource.query(fields, criteria),
+                                     resource.fields['id'], limit, last_id)
         return jsonify({
             'success': True,
-            'actors': actors
+            key: serialize(rows),
+            'next_cursor': next_cursor
+            }), 200
+
+    def detail_resource(resource, key, id):
+        try:
+            fields, include = resource.parse(request.args)
+        except ValueError:
+            abort(400)
+        legacy = resource.is_legacy(request.args)
+        # the historical detail always embeds the related rows
+        item, related = resource.detail(id, fields, include or legacy)
+        if item is None:
+            abort(404)
+        prefix = 'actor' if resource is MOVIES else 'movie'
+        g.cache_tags.update(f'{prefix}:{related_id}'
+                            for related_id, _ in related)
+        related = [{'id': related_id, 'name': name}
+                   for related_id, name in related]
+        if legacy:
+            return jsonify({
+                'success': True,
+                key: item['name'],
+                resource.include: related
+                }), 200
+        if include:
+            item[resource.include] = related
+        return jsonify({
+            'success': True,
+            key: [item]
             }), 200
 
     '''
-    GET /actors/id
+    GET /actors/<id>/costars
+        the actors who played in a movie with the actor, ordered by id
+        and paginated with ?limit= and ?cursor= like GET /actors
+        served by the in-memory co-star graph
+        404 if the actor does not exist
     '''
-    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @app.route('/actors/<int:actor_id>/costars', methods=['GET'])
+    @requires_auth('get:actors')
+    def costars(_, actor_id):
+        try:
+            limit, last_id = page_args(request.args)
+        except ValueError:
+            abort(400)
+        costar_graph.refresh()
+        ids = [id for id in costar_graph.costars(actor_id)
+               if last_id is None or id > last_id]
+        page = ids[:limit]
+        next_cursor = encode_cursor(page[-1]) if len(ids) > limit else None
+        # the name of the actor too, to check it exists
+        names = dict(db.session.query(Actor.id, Actor.name).filter(
+            Actor.id.in_(page + [actor_id])))
+        if actor_id not in names:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'actors': [{'id': id, 'name': names.get(id)} for id in page],
+            'next_cursor': next_cursor
+            }), 200
+
+    '''
+    GET /actors/<a>/path/<b>
+        degrees of separation: a shortest chain of co-stars from a to b,
+        movies[i] links actors[i] and actors[i + 1]
+        404 if one of them does not exist or they are not connected
+        within ?max_depth= movies (default and maximum GRAPH_MAX_DEPTH)
+    '''
+    @app.route('/actors/<int:source_id>/path/<int:target_id>',
+               methods=['GET'])
     @requires_auth('get:actors')
-    def role_actor(actor_id):
-        actor = Actor.query.get(actor_id)
-        roles_actor = Role.query.join(Movie).filter(
-            Role.actor_id == actor_id).all()
-        movies = [role.movie() for role in roles_actor]
+    def costar_path(_, source_id, target_id):
+        try:
+            max_depth = min(int(request.args.get(
+                'max_depth', GRAPH_MAX_DEPTH)), GRAPH_MAX_DEPTH)
+        except ValueError:
+            abort(400)
+        costar_graph.refresh()
+        found = costar_graph.path(source_id, target_id, max_depth)
+        if found is None:
+            abort(404)
+        actor_ids, movie_ids = found
+        actors = dict(db.session.query(Actor.id, Actor.name).filter(
+            Actor.id.in_(actor_ids)))
+        movies = dict(db.session.query(Movie.id, Movie.title).filter(
+            Movie.id.in_(movie_ids)))
+        if len(actors) < len(set(actor_ids)):
+            abort(404)
+        return jsonify({
+            'success': True,
+            'degrees': len(movie_ids),
+            'actors': [{'id': id, 'name': actors[id]} for id in actor_ids],
+            'movies': [{'id': id, 'name': movies.get(id)}
+                       for id in movie_ids]
+            }), 200
+
+    '''
+    GET /graph/stats
+        version, size, build time and memory of the co-star graph
+    '''
+    @app.route('/graph/stats', methods=['GET'])
+    @requires_auth('get:actors')
+    def graph_stats(_):
+        return jsonify({
+            'success': True,
+            'graph': costar_graph.stats()
+            }), 200
+
+    '''
+    GET /stats
+        movies per year, cast sizes, actors by gender and age and the
+        most prolific actors, computed with GROUP BY queries and cached
+        until one of the tables changes
+        conditional: ETag/Last-Modified, 304 if unchanged
+    '''
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional('movies', 'actors', 'roles')
+    def get_stats(_):
+        stats, versions = catalog_stats()
+        return jsonify({
+            'success': True,
+            'stats': stats,
+            'versions': versions
+            }), 200
+
+    '''
+    GET /cache/stats
+        hit rate and evictions of the response cache
+    '''
+    @app.route('/cache/stats', methods=['GET'])
+    @requires_auth('get:movies')
+    def cache_stats(_):
         return jsonify({
             'success': True,
-            'actors': actor.name,
-            'movies': movies
+            'cache': response_cache.stats()
             }), 200
+
+    '''
+    GET /metrics
+        latency histograms per route, time in auth, pool, db and
+        serialize, queries per request (see metrics.py) in the Prometheus
+        text format
+        authorized by the bearer METRICS_TOKEN (the scraper) or a token
+        with get:movies
+    '''
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        if not metrics_token_valid(request.headers.get('Authorization')):
+            payload = verify_decode_jwt_cached(get_token_auth_header())
+            check_permissions('get:movies', payload)
+        return Response(render_metrics(),
+                        mimetype='text/plain; version=0.0.4')
+
     '''
     DELETE /movies
+        the casting links and the movie are deleted by id in one
+        transaction, without loading the movie first
     '''
     @app.route("/movies/<int:movie_id>", methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(_, movie_id):
-        # check if the item is existing
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         try:
-            if movie is None:
-                abort(404)
-
-            movie.delete()
-            return jsonify({
-                    'success': True,
-                    'delete': movie.id
-                }), 200
-        except Exception:
+            deleted = delete_movie_row(movie_id)
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
             abort(422)
+        # respond with 404 if no row was deleted = <id> not found
+        if not deleted:
+            abort(404)
+        return jsonify({
+                'success': True,
+                'delete': movie_id
+            }), 200
 
     '''
     DELETE /actors
@@ -122,19 +356,19 @@ def create_app(test_config=None):
     @app.route("/actors/<int:actor_id>", methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(_, actor_id):
-        # check if the item is existing
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
         try:
-            if actor is None:
-                abort(404)
-
-            actor.delete()
-            return jsonify({
-                    'success': True,
-                    'delete': actor.id
-                }), 200
-        except Exception:
+            deleted = delete_actor_row(actor_id)
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
             abort(422)
+        # respond with 404 if no row was deleted = <id> not found
+        if not deleted:
+            abort(404)
+        return jsonify({
+                'success': True,
+                'delete': actor_id
+            }), 200
 
     '''
     POST /movies
@@ -196,64 +430,208 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    '''
+    POST /movies/bulk and POST /actors/bulk
+        body: an array of movies (actors) or {"movies": [...]}
+        all the items are inserted in one transaction
+        ?partial=true inserts the valid items and reports the others in
+        errors instead of refusing the whole batch
+    '''
+    def bulk_create(model, key, validate):
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get(key)
+        if not isinstance(items, list) or len(items) > BULK_MAX_ITEMS:
+            abort(400)
+        partial = request.args.get('partial', 'false').lower() == 'true'
+
+        rows, errors = validate_items(items, validate)
+        if errors and not partial:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'errors': errors
+            }), 422
+        try:
+            created, db_errors = create_items(model, rows, partial)
+        except SQLAlchemyError:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            key: [model(id=id, **row).short() for id, row in created],
+            'errors': sorted(errors + db_errors, key=lambda e: e['index'])
+        })
+
+    @app.route("/movies/bulk", methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(payload):
+        return bulk_create(Movie, 'movies', validate_movie)
+
+    @app.route("/actors/bulk", methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(payload):
+        return bulk_create(Actor, 'actors', validate_actor)
+
+    '''
+    POST /roles and DELETE /roles
+        casting of actors in movies
+        body: an array of {"movie_id", "actor_id"} or {"roles": [...]}
+        the whole batch is written in one transaction, the pairs already
+        cast (not cast) are skipped
+    '''
+    def role_pairs():
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get('roles')
+        if not isinstance(items, list) or len(items) > BULK_MAX_ITEMS:
+            abort(400)
+        rows, errors = validate_items(items, validate_role)
+        if errors:
+            abort(422)
+        return rows
+
+    @app.route("/roles", methods=['POST'])
+    @requires_auth('patch:movies')
+    def create_roles(_):
+        rows = role_pairs()
+        try:
+            created = insert_roles([row for _, row in rows])
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        return jsonify({
+            'success': True,
+            'created': created
+        })
+
+    @app.route("/roles", methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def delete_roles_bulk(_):
+        rows = role_pairs()
+        try:
+            deleted = delete_roles([row for _, row in rows])
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        return jsonify({
+            'success': True,
+            'deleted': deleted
+        })
+
+    '''
+    POST /batch
+        body: an array of {"method", "path", "body"} or
+        {"operations": [...]}
+        the token is verified once, each operation needs the permission
+        of its route
+        all the operations are run in one transaction, ?atomic=false
+        commits them one by one and reports the failures
+    '''
+    @app.route("/batch", methods=['POST'])
+    @requires_auth(None)
+    def batch(payload):
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get('operations')
+        if not isinstance(items, list) or len(items) > BATCH_MAX_OPERATIONS:
+            abort(400)
+        atomic = request.args.get('atomic', 'true').lower() != 'false'
+
+        operations, errors = validate_items(items, validate_operation)
+        if errors:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'errors': errors
+            }), 422
+        try:
+            results, failed = run_batch(
+                [operation for _, operation in operations], payload, atomic)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        if failed is not None:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'unprocessable',
+                'failed': failed,
+                'results': results
+            }), 422
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+
     '''
         PATCH /movies/<id>
+        one UPDATE ... RETURNING, no row returned = <id> not found
     '''
     @app.route("/movies/<int:movie_id>", methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(_, movie_id):
-        # check if the item is existing
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        # respond with 404 if movie is empty = <id> not founbd
-        if movie is None:
-            abort(404)
         # check the body
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+        values = {key: body[key] for key in ('title', 'release')
+                  if key in body}
         try:
-            body = request.get_json()
-            movie.title = body.get('title', movie.title)
-            if "release" in body:
-                movie.release = body.get('release')
-            movie.update()
-
-            return jsonify({
-                    'success': True,
-                    'movies': [movie.short()],
-                })
-        except Exception:
+            movie = update_movie_row(movie_id, values)
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
             abort(422)
+        # respond with 404 if movie is empty = <id> not founbd
+        if movie is None:
+            abort(404)
+        return jsonify({
+                'success': True,
+                'movies': [movie],
+            })
 
     '''
         PATCH /actors/<id>
+        one UPDATE ... RETURNING, no row returned = <id> not found
     '''
     @app.route("/actors/<int:actor_id>", methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actors(_, actor_id):
-        # check if the item is existing
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        # respond with 404 if actor is empty = <id> not founbd
-        if actor is None:
-            abort(404)
         # check the body
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+        values = {key: body[key] for key in ('name', 'gender', 'age')
+                  if key in body}
         try:
-            body = request.get_json()
-            if "name" in body:
-                actor.name = body.get('name')
-            if "gender" in body:
-                actor.gender = body.get('gender')
-            if "age" in body:
-                actor.age = body.get('age')
-
-            actor.update()
-
-            return jsonify({
-                    'success': True,
-                    'actors': [actor.short()],
-                })
-        except Exception:
+            actor = update_actor_row(actor_id, values)
+            commit()
+        except SQLAlchemyError:
+            db.session.rollback()
             abort(422)
+        # respond with 404 if actor is empty = <id> not founbd
+        if actor is None:
+            abort(404)
+        return jsonify({
+                'success': True,
+                'actors': [actor],
+            })
 
     # Error Handling
 
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "bad request"
+            }), 400
+
     @app.errorhandler(405)
     def not_found(error):
         return jsonify({
@@ -0,0 +1,360 @@
+import re
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict, MIMEAccept
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound
+from werkzeug.http import (parse_accept_header, parse_etags, parse_date,
+                           http_date)
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import app as flask_app
+from models import (database_path, engine_options, PGBOUNCER,
+                    STATEMENT_TIMEOUT_MS, TableVersion)
+from auth import (AuthError, parse_auth_header, check_permissions,
+                  token_cache, token_cache_key, verify_and_cache)
+from json_provider import dumps
+from queries import MOVIES, ACTORS, group_related
+from pagination import page_args, page_query, split_page
+from conditional import (compute_etag, not_modified, last_modified_of,
+                         versions_stamp)
+from response_cache import response_cache
+from export import wants_ndjson
+from singleflight import AsyncSingleFlight
+from metrics import start_request, finish_request, timed
+
+'''
+Async serving mode
+    run with uvicorn (or gunicorn -k uvicorn.workers.UvicornWorker):
+        uvicorn asgi:app --workers 4
+    the read routes of the catalog are served by coroutines on an async
+    engine (asyncpg, aiosqlite for SQLite), a worker keeps serving while
+    they wait on PostgreSQL:
+        GET /movies, GET /actors, GET /movies/<id>, GET /actors/<id>
+        (with the same fields, include, ids, search, pagination,
+        ETag/304 and response cache as app.py)
+    every other request (writes, exports, batch, graph, stats) is handed
+    to the flask app of app.py in a thread pool, and all the errors are
+    rendered by its error handlers: the contract of the API is unchanged
+    the token is verified in a thread (signature check and, for an unknown
+    key id, the fetch of the key set) unless it is in token_cache
+'''
+
+logger = logging.getLogger(__name__)
+
+CORS_HEADERS = [
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization,true'),
+    ('Access-Control-Allow-Methods', 'GET,POST,PUT,PATCH,DELETE,OPTIONS'),
+    ('Access-Control-Allow-Credentials', 'true'),
+]
+
+
+'''
+async_database_url(url) / async_engine_options(url)
+    the async driver and the options of models.engine_options, asyncpg
+    takes the statement timeout as a server setting and must not cache
+    prepared statements behind PgBouncer
+'''
+
+
+def async_database_url(url):
+    if url.startswith('sqlite'):
+        return url.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+    return re.sub(r'^postgresql(\+\w+)?://', 'postgresql+asyncpg://', url)
+
+
+def async_engine_options(url):
+    options = engine_options(url)
+    # the async engine has its own pool class and driver arguments
+    options.pop('poolclass', None)
+    options.pop('connect_args', None)
+    if url.startswith('postgresql'):
+        connect_args = {}
+        if PGBOUNCER:
+            connect_args['statement_cache_size'] = 0
+            connect_args['prepared_statement_cache_size'] = 0
+        elif STATEMENT_TIMEOUT_MS:
+            connect_args['server_settings'] = {
+                'statement_timeout': str(STATEMENT_TIMEOUT_MS)}
+        options['connect_args'] = connect_args
+    return options
+
+
+class Request:
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('utf-8')
+        self.full_path = self.path + '?' + self.query_string
+        # key of the response cache, with the versions on the list routes
+        self.cache_key = self.full_path
+        self.args = MultiDict(parse_qsl(self.query_string,
+                                        keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower():
+                        value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.accept = self.headers.get('accept', '')
+        self.accept_mimetypes = parse_accept_header(self.accept, MIMEAccept)
+        self.if_none_match = parse_etags(self.headers.get('if-none-match'))
+        self.if_modified_since = parse_date(
+            self.headers.get('if-modified-since'))
+
+
+class Response:
+    def __init__(self, status, body=b'', headers=()):
+        self.status = status
+        self.body = body
+        self.headers = list(headers)
+
+    async def send(self, send):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [(name.lower().encode('latin-1'),
+                         str(value).encode('latin-1'))
+                        for name, value in self.headers] + [
+                (b'content-length', str(len(self.body)).encode('ascii'))],
+        })
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class AsyncAPI:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.fallback = WSGIMiddleware(wsgi_app)
+        self.engine = None
+        self.flights = AsyncSingleFlight()
+        # (path pattern, rule of app.py, permission, handler, arguments of
+        # the handler)
+        self.routes = [
+            (re.compile(r'^/movies$'), '/movies', 'get:movies',
+             self.list_route,
+             (MOVIES, 'movies', ('movies', 'actors', 'roles'), ())),
+            (re.compile(r'^/actors$'), '/actors', 'get:actors',
+             self.list_route,
+             (ACTORS, 'actors', ('actors',), ('movies', 'roles'))),
+            (re.compile(r'^/movies/(\d+)$'), '/movies/<int:movie_id>',
+             'get:movies', self.detail_route,
+             (MOVIES, 'movies', 'movie', 'actor')),
+            (re.compile(r'^/actors/(\d+)$'), '/actors/<int:actor_id>',
+             'get:actors', self.detail_route,
+             (ACTORS, 'actors', 'actor', 'movie')),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, rule, permission, handler, arguments in \
+                    self.routes:
+                match = pattern.match(scope['path'])
+                if match is None:
+                    continue
+                request = Request(scope)
+                # the streamed exports stay on the flask app
+                if not wants_ndjson(request):
+                    start_request()
+                    response = await self.dispatch(
+                        request, permission, handler,
+                        arguments + match.groups())
+                    server_timing = finish_request('GET', rule,
+                                                   response.status)
+                    response.headers.append(('Server-Timing', server_timing))
+                    return await response.send(send)
+                break
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    '''
+    start()
+        creates the async engine in the worker process (its connections
+        belong to the event loop of the worker)
+    '''
+    def start(self):
+        if self.engine is None:
+            self.engine = create_async_engine(
+                async_database_url(database_path),
+                **async_engine_options(database_path))
+
+    async def dispatch(self, request, permission, handler, arguments):
+        try:
+            payload = await self.verify(request)
+            check_permissions(permission, payload)
+            request.permissions = tuple(sorted(payload['permissions']))
+            self.start()
+            async with AsyncSession(self.engine) as session:
+                response = await handler(session, request, *arguments)
+        except (HTTPException, AuthError) as e:
+            response = self.error_response(e)
+        except Exception as e:
+            logger.exception('async route %s', request.path)
+            response = self.error_response(e)
+        # the headers of flask_cors.CORS(app) and app.after_request
+        headers = response.headers + CORS_HEADERS
+        if 'origin' in request.headers:
+            headers += [('Access-Control-Allow-Origin',
+                         request.headers['origin']), ('Vary', 'Origin')]
+        else:
+            headers.append(('Access-Control-Allow-Origin', '*'))
+        return Response(response.status, response.body, headers)
+
+    async def verify(self, request):
+        with timed('auth'):
+            token = parse_auth_header(request.headers.get('authorization'))
+            key = token_cache_key(token)
+            payload = token_cache.get(key)
+            if payload is None:
+                payload = await asyncio.get_running_loop().run_in_executor(
+                    None, verify_and_cache, token, key)
+        return payload
+
+    '''
+    error_response(error)
+        renders the error with the error handlers of the flask app
+    '''
+    def error_response(self, error):
+        with self.wsgi_app.test_request_context():
+            try:
+                rv = self.wsgi_app.handle_user_exception(error)
+            except Exception as e:
+                rv = self.wsgi_app.handle_exception(e)
+            response = self.wsgi_app.make_response(rv)
+        return Response(response.status_code, response.get_data(),
+                        [('Content-Type', response.content_type)])
+
+    '''
+    cached(request, compute)
+        the body of the response cache, computed by the coroutine compute
+        on a miss, once for the concurrent identical requests
+    '''
+    async def cached(self, request, compute):
+        flight = (request.cache_key, request.permissions)
+        body, expiring = response_cache.lookup(request.cache_key)
+        if body is None or (expiring and not self.flights.running(flight)):
+            body, _ = await self.flights.do(flight, compute)
+        return body
+
+    '''
+    list_route / detail_route
+        the async twins of list_resource and detail_resource in app.py
+        behind @conditional and @cached
+    '''
+    async def list_route(self, session, request, resource, key, tables,
+                         includes):
+        args = request.args
+        try:
+            fields, include = resource.parse(args)
+            ids = resource.parse_ids(args)
+            criteria = resource.criteria(args)
+        except ValueError:
+            raise BadRequest()
+        legacy = resource.is_legacy(args)
+
+        names = tables + includes if args.get('include') else tables
+        versions = TableVersion.versions(await session.execute(
+            TableVersion.current_statement(*names)))
+        etag = compute_etag(versions, request.full_path, request.accept)
+        request.cache_key = request.full_path + '#' + versions_stamp(versions)
+        last_modified = last_modified_of(versions)
+        headers = [('ETag', 'W/"%s"' % etag)]
+        if last_modified is not None:
+            headers.append(('Last-Modified', http_date(last_modified)))
+        if not_modified(etag, last_modified, request.if_none_match,
+                        request.if_modified_since):
+            return Response(304, b'', headers)
+
+        async def compute():
+            tags = {key}
+            if include and key == 'actors':
+                tags.add('movies')
+            generation = response_cache.generation
+            if ids is not None:
+                found = resource.group_loaded(await session.execute(
+                    resource.load_statement(
+                        [resource.fields['id'].in_(ids), *criteria],
+                        fields, include)), fields)
+                items, missing = resource.order_by_ids(
+                    ids, found, include, legacy)
+                data = {'success': True, key: items, 'missing': missing}
+            else:
+                try:
+                    limit, last_id = page_args(args)
+                except ValueError:
+                    raise BadRequest()
+                column = resource.fields['id']
+                rows = (await session.execute(page_query(
+                    resource.select(fields, criteria), column, limit,
+                    last_id))).all()
+                rows, next_cursor = split_page(rows, column, limit)
+                related = {}
+                if include and rows:
+                    related = group_related(await session.execute(
+                        resource.related_statement([row.id for row in rows])))
+                data = {
+                    'success': True,
+                    key: resource.serialize(rows, fields, include, legacy,
+                                            related),
+                    'next_cursor': next_cursor
+                }
+            body = dumps(data) + b'\n'
+            if generation == response_cache.generation:
+                response_cache.set(request.cache_key, body, tags)
+            return body
+
+        body = await self.cached(request, compute)
+        return Response(200, body, headers + [
+            ('Content-Type', 'application/json')])
+
+    async def detail_route(self, session, request, resource, key, prefix,
+                           related_prefix, id):
+        async def compute():
+            try:
+                fields, include = resource.parse(request.args)
+            except ValueError:
+                raise BadRequest()
+            legacy = resource.is_legacy(request.args)
+            generation = response_cache.generation
+            found = resource.group_loaded(await session.execute(
+                resource.load_statement([resource.fields['id'] == id],
+                                        fields, include or legacy)), fields)
+            if id not in found:
+                raise NotFound()
+            item, related = found[id]
+            tags = {f'{prefix}:{id}'} | {
+                f'{related_prefix}:{related_id}' for related_id, _ in related}
+            related = [{'id': related_id, 'name': name}
+                       for related_id, name in related]
+            if legacy:
+                data = {'success': True, key: item['name'],
+                        resource.include: related}
+            else:
+                if include:
+                    item[resource.include] = related
+                data = {'success': True, key: [item]}
+            body = dumps(data) + b'\n'
+            if generation == response_cache.generation:
+                response_cache.set(request.cache_key, body, tags)
+            return body
+
+        id = int(id)
+        versions = TableVersion.versions(await session.execute(
+            TableVersion.current_statement('movies', 'actors', 'roles')))
+        request.cache_key = request.full_path + '#' + versions_stamp(versions)
+        body = await self.cached(request, compute)
+        return Response(200, body, [('Content-Type', 'application/json')])
+
+
+app = AsyncAPI(flask_app)
@@ -1,9 +1,15 @@
 import os
 import json
+import time
+import hashlib
 from flask import request, _request_ctx_stack, abort, Flask
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jose.exceptions import JWTError
+from jose.utils import base64url_decode
+from jwks import JWKSStore
+from cache import TTLCache
+from metrics import timed
 # don't forget tp update wheel and werkzeug !
 # use pip3 install --force-reinstall -r requirements.t
 
@@ -12,9 +18,30 @@ from urllib.request import urlopen
 # API_AUDIENCE = 'dev'
 
 AUTH0_DOMAIN = os.environ["AUTH0_DOMAIN"]
-ALGORITHMS = os.environ["ALGO"]
+# comma separated, e.g. ALGO=RS256
+ALGORITHMS = [alg.strip() for alg in os.environ["ALGO"].split(",")
+              if alg.strip()]
 API_AUDIENCE = os.environ["API"]
 
+# the key set is cached in memory, JWKS_FILE seeds it from a local file
+# (without JWKS_URL the store then never goes to the network)
+JWKS_FILE = os.environ.get("JWKS_FILE")
+JWKS_URL = os.environ.get(
+    "JWKS_URL",
+    None if JWKS_FILE else f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+jwks_store = JWKSStore(
+    url=JWKS_URL,
+    path=JWKS_FILE,
+    refresh_interval=int(os.environ.get("JWKS_REFRESH_SECONDS", 600)),
+    min_refresh_interval=int(os.environ.get("JWKS_MIN_REFRESH_SECONDS", 30)))
+
+# decoded payloads of already verified tokens, an entry never outlives
+# the exp claim of its token
+token_cache = TTLCache(
+    maxsize=int(os.environ.get("TOKEN_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("TOKEN_CACHE_TTL", 300)))
+
 # to get the token after the user signed in
 # https://coffee-shop-theo.eu.auth0.com/authorize?audience=drinks&response_type=
 # token&client_id=oeQvnBEzL0QM0sd2qMjS21ARNL9Rlh6L
@@ -49,7 +76,12 @@ implement get_token_auth_header() method
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """Returns the token of an Authorization header value
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -116,6 +148,7 @@ implement verify_decode_jwt(token) method
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the key set is served by jwks_store and not fetched per request
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -127,33 +160,36 @@ implement verify_decode_jwt(token) method
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    verifier = jwks_store.get_verifier(unverified_header['kid'])
+    if verifier is None and not jwks_store.has_keys():
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if verifier is not None:
         try:
+            # the signature is checked with the prebuilt key, jose only
+            # decodes the payload and validates the claims
+            if unverified_header.get('alg') not in ALGORITHMS:
+                raise JWTError('The specified alg value is not allowed')
+            signing_input, _, signature = token.rpartition('.')
+            signature = base64url_decode(signature.encode('utf-8'))
+            if not verifier.verify(signing_input.encode('utf-8'), signature):
+                raise JWTError('Signature verification failed.')
             payload = jwt.decode(
                 token,
-                rsa_key,
+                None,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
             return payload
         except jwt.ExpiredSignatureError:
@@ -168,6 +204,12 @@ def verify_decode_jwt(token):
                 'code': 'invalid_claims',
                 'description': str1
             }, 401)
+        except JWTError:
+            # refused algorithm or signature
+            raise AuthError({
+                'code': 'invalid_token',
+                'description': 'Token signature is invalid.'
+            }, 401)
         except Exception:
             raise AuthError({
                 'code': 'invalid_header',
@@ -176,7 +218,40 @@ def verify_decode_jwt(token):
     raise AuthError({
                 'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
-            }, 403)
+            }, 401)
+
+
+'''
+verify_decode_jwt_cached(token)
+    @INPUTS
+        token: a json web token (string)
+
+    returns the payload of a token verified before from token_cache
+    otherwise verifies the token with verify_decode_jwt and caches the
+    payload until min(exp, now + TOKEN_CACHE_TTL)
+    the cache is keyed by the sha256 of the token, never the token itself
+'''
+
+
+def verify_decode_jwt_cached(token):
+    key = token_cache_key(token)
+    payload = token_cache.get(key)
+    if payload is not None:
+        return payload
+    return verify_and_cache(token, key)
+
+
+def token_cache_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def verify_and_cache(token, key):
+    payload = verify_decode_jwt(token)
+    ttl = token_cache.ttl
+    if 'exp' in payload:
+        ttl = min(ttl, payload['exp'] - time.time())
+    token_cache.set(key, payload, ttl=ttl)
+    return payload
 
 
 '''
@@ -186,10 +261,15 @@ implement @requires_auth(permission) decorator method
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        (through verify_decode_jwt_cached for tokens seen before)
     it should use the check_permissions method validate claims and
     check the requested permission
     return the decorator which passes the decoded payload to the decorated
     method
+    permission=None only verifies the token (POST /batch checks the
+    permission of every operation)
+    the permission is kept on the wrapper and the route is reachable
+    without the token check as wrapper.__wrapped__
 '''
 
 
@@ -197,9 +277,12 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = verify_decode_jwt_cached(token)
+                if permission is not None:
+                    check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
+        wrapper.permission = permission
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,113 @@
+import os
+from flask import current_app, request, abort
+from werkzeug.exceptions import HTTPException
+
+from models import db
+from auth import AuthError, check_permissions
+
+'''
+Batch of API operations
+    used by POST /batch
+    the token is verified once for the whole batch, every operation is
+    then dispatched to its route with the permission of the route checked
+    against the same payload
+        - atomic (default): the operations share one transaction, the
+          first failing operation rolls back all of them
+        - ?atomic=false: every operation commits on its own and the
+          failures are only reported
+    only the write methods are accepted, the batch reads are served by
+    GET /movies?ids= and GET /actors?ids=
+'''
+
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+BATCH_METHODS = ('POST', 'PATCH', 'DELETE')
+
+
+'''
+validate_operation(item)
+    returns (method, path, body) of one operation of the batch
+    {"method": "PATCH", "path": "/actors/1", "body": {"age": 40}}
+    raises a ValueError otherwise
+'''
+
+
+def validate_operation(item):
+    if not isinstance(item, dict):
+        raise ValueError('operation must be an object')
+    method = str(item.get('method', '')).upper()
+    path = item.get('path')
+    if method not in BATCH_METHODS:
+        raise ValueError('method must be one of ' + ', '.join(BATCH_METHODS))
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise ValueError('path must be an absolute path')
+    return method, path, item.get('body')
+
+
+'''
+run_operation(method, path, body, payload)
+    runs one operation in a request context of its own
+    returns {'status', 'body'} with the response of the route, the
+    errors are answered by the error handlers of the app
+'''
+
+
+def run_operation(method, path, body, payload):
+    app = current_app._get_current_object()
+    with app.test_request_context(path, method=method, json=body):
+        try:
+            if request.routing_exception is not None:
+                raise request.routing_exception
+            view = app.view_functions[request.url_rule.endpoint]
+            permission = getattr(view, 'permission', None)
+            # the public routes and /batch itself are not dispatched
+            if permission is None:
+                abort(400)
+            check_permissions(permission, payload)
+            response = app.make_response(
+                view.__wrapped__(payload, **request.view_args))
+        except (HTTPException, AuthError) as e:
+            response = app.make_response(app.handle_user_exception(e))
+        return {
+            'status': response.status_code,
+            'body': response.get_json(silent=True)
+            }
+
+
+'''
+run_batch(operations, payload, atomic)
+    @INPUTS
+        operations: list of (method, path, body) from validate_operation
+        payload: the decoded token of the batch request
+        atomic: one transaction for all the operations
+    returns (results, failed)
+        results: list of {'status', 'body'} in the order of the operations
+        failed: index of the operation which rolled back the atomic batch,
+            None otherwise
+'''
+
+
+def run_batch(operations, payload, atomic=True):
+    results = []
+    if not atomic:
+        for method, path, body in operations:
+            results.append(run_operation(method, path, body, payload))
+            if results[-1]['status'] >= 400:
+                db.session.rollback()
+        return results, None
+
+    db.session.info['batch'] = True
+    try:
+        for index, (method, path, body) in enumerate(operations):
+            results.append(run_operation(method, path, body, payload))
+            if (results[-1]['status'] >= 400 or
+                    db.session.info.get('batch_failed')):
+                db.session.rollback()
+                return results, index
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.info.pop('batch', None)
+        db.session.info.pop('batch_failed', None)
+    db.session.commit()
+    return results, None
@@ -0,0 +1,64 @@
+'''
+Benchmark of the json serialization of a large list payload
+
+    encodes a GET /movies style payload of 10k rows (Movie.short() plus
+    the release DateTime) with
+        - flask: the stdlib encoder with the options of flask.jsonify
+          (sorted keys, pretty print checks, str output encoded to utf-8)
+        - one run per backend of json_provider (stdlib, orjson if
+          installed)
+
+    usage: python benchmarks/bench_json.py [rows] [iterations]
+'''
+import os
+import sys
+import json
+import time
+from datetime import datetime, timedelta
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+
+def payload():
+    start = datetime(1990, 1, 1)
+    return {
+        'success': True,
+        'movies': [{
+            'id': i,
+            'name': 'Movie %d' % i,
+            'release': start + timedelta(days=i),
+            'actors': ['Actor %d' % (i + j) for j in range(5)]
+            } for i in range(ROWS)]
+        }
+
+
+def flask_dumps(data):
+    return (json.dumps(data, default=lambda o: o.isoformat(), indent=None,
+                       separators=(',', ':'), sort_keys=True) +
+            '\n').encode('utf-8')
+
+
+def run(name, dumps, data):
+    size = len(dumps(data))
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        dumps(data)
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+    print(f'{name:8} {elapsed * 1000:8.1f} ms/payload '
+          f'{size / elapsed / 1e6:8.1f} MB/s')
+    return elapsed
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from json_provider import create_provider, StdlibProvider
+
+    data = payload()
+    base = run('flask', flask_dumps, data)
+    providers = {provider.name: provider
+                 for provider in (StdlibProvider(), create_provider())}
+    for provider in providers.values():
+        elapsed = run(provider.name, provider.dumps, data)
+        print(f'{"":8} {base / elapsed:8.2f}x flask')
@@ -0,0 +1,86 @@
+'''
+Micro-benchmark of the token verification
+
+    compares the tokens verified per second
+        - before: the jwk dict is rebuilt and handed to jose on every
+          decode (jose parses the modulus and builds the key each time)
+        - after: verify_decode_jwt with the verifier prebuilt per kid
+
+    runs offline: a RSA key pair is generated and the key store is
+    seeded from a temporary jwks.json
+
+    usage: python benchmarks/bench_jwt_verify.py [iterations]
+'''
+import os
+import sys
+import json
+import time
+import base64
+import tempfile
+
+import rsa
+from jose import jwt
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+DOMAIN = 'bench.auth0.com'
+
+
+def b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def setup():
+    public, private = rsa.newkeys(2048)
+    jwks = {'keys': [{'kty': 'RSA', 'kid': 'bench', 'use': 'sig',
+                      'alg': 'RS256', 'n': b64(public.n),
+                      'e': b64(public.e)}]}
+    path = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+    with open(path, 'w') as f:
+        json.dump(jwks, f)
+
+    os.environ.update({'AUTH0_DOMAIN': DOMAIN, 'ALGO': 'RS256',
+                       'API': 'bench', 'JWKS_FILE': path})
+    os.environ.pop('JWKS_URL', None)
+    token = jwt.encode({'iss': f'https://{DOMAIN}/', 'aud': 'bench',
+                        'exp': int(time.time()) + 3600,
+                        'permissions': ['get:movies']},
+                       private.save_pkcs1().decode(), algorithm='RS256',
+                       headers={'kid': 'bench'})
+    return jwks, token
+
+
+def verify_before(jwks, token):
+    unverified_header = jwt.get_unverified_header(token)
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return jwt.decode(token, rsa_key, algorithms='RS256',
+                      audience='bench', issuer=f'https://{DOMAIN}/')
+
+
+def run(name, verify):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        verify()
+    elapsed = time.perf_counter() - start
+    print(f'{name:8} {ITERATIONS / elapsed:10.0f} tokens/s')
+    return elapsed
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    jwks, token = setup()
+    import auth
+
+    assert verify_before(jwks, token) == auth.verify_decode_jwt(token)
+    before = run('before', lambda: verify_before(jwks, token))
+    after = run('after', lambda: auth.verify_decode_jwt(token))
+    print(f'speedup  {before / after:10.2f}x')
@@ -0,0 +1,72 @@
+'''
+Throughput of the sync and the async serving modes
+
+    starts the server twice with gunicorn.conf.py and the same number of
+    workers, then sends the same load (load_test.run) to each:
+        - sync: app:app on gthread workers (GUNICORN_THREADS threads)
+        - async: asgi:app on uvicorn workers (one event loop per worker)
+    run from the src directory with the environment of setup.sh, e.g.
+
+        WEB_CONCURRENCY=2 python benchmarks/compare_modes.py 64 20
+
+    the gap grows with the latency of the database and of the identity
+    provider: the threads of a sync worker wait on it, the event loop
+    keeps serving the other clients
+
+    usage: python benchmarks/compare_modes.py [clients] [seconds] [path...]
+'''
+import os
+import sys
+import time
+import socket
+import subprocess
+
+from load_test import TOKEN, run, report
+
+PATHS = ['/movies?include=actors', '/actors/1', '/movies?ids=1,2,3']
+PORT = int(os.environ.get('COMPARE_PORT', 5099))
+
+MODES = (
+    ('sync', 'app:app', {}),
+    ('async', 'asgi:app',
+     {'GUNICORN_WORKER_CLASS': 'uvicorn.workers.UvicornWorker'}),
+)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit('the server did not start on port %d' % port)
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    paths = sys.argv[3:] or PATHS
+    if not TOKEN:
+        sys.exit('set LOAD_TEST_TOKEN to a valid bearer token')
+    urls = ['http://127.0.0.1:%d%s' % (PORT, path) for path in paths]
+    print('%d clients, %.0fs, %s' % (clients, seconds, ', '.join(paths)))
+    for name, application, settings in MODES:
+        env = dict(os.environ, PORT=str(PORT), **settings)
+        server = subprocess.Popen(
+            ['gunicorn', '-c', 'gunicorn.conf.py', application], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(PORT)
+            # warm up the connections, the token cache and the graph
+            run(urls, clients, 1, TOKEN)
+            print('== %s (%s)' % (name, application))
+            report(*run(urls, clients, seconds, TOKEN))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Load test of a running server
+
+    sends GET requests from concurrent clients during a fixed time and
+    reports the throughput, the latency percentiles and the errors, e.g.
+    to compare the gunicorn settings (workers, threads, pool sizes):
+
+        gunicorn -c gunicorn.conf.py app:app
+        python benchmarks/load_test.py http://localhost:5000/movies 32 20
+
+        WEB_CONCURRENCY=1 GUNICORN_THREADS=1 gunicorn -c gunicorn.conf.py app:app
+        python benchmarks/load_test.py http://localhost:5000/movies 32 20
+
+    the bearer token is read from LOAD_TEST_TOKEN (default: the
+    token_assistant of setup.sh)
+    the extra arguments are paths requested in turn instead of the url,
+    e.g. "/movies?limit=10" "/actors?ids=1,2"
+
+    usage: python benchmarks/load_test.py url [clients] [seconds] [path...]
+'''
+import os
+import sys
+import time
+import threading
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
+
+TOKEN = os.environ.get('LOAD_TEST_TOKEN', os.environ.get('token_assistant'))
+
+
+def client(urls, token, deadline, latencies, errors, lock):
+    own = []
+    failed = 0
+    index = 0
+    while time.perf_counter() < deadline:
+        request = Request(urls[index % len(urls)], headers={
+            'Authorization': 'Bearer %s' % token})
+        index += 1
+        start = time.perf_counter()
+        try:
+            with urlopen(request, timeout=30) as response:
+                response.read()
+            own.append(time.perf_counter() - start)
+        except (HTTPError, URLError, OSError):
+            failed += 1
+    with lock:
+        latencies.extend(own)
+        errors.append(failed)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+'''
+run(urls, clients, seconds, token)
+    returns (sorted latencies, errors, elapsed seconds)
+'''
+
+
+def run(urls, clients, seconds, token=TOKEN):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=client, args=(
+        urls, token, deadline, latencies, errors, lock))
+        for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return latencies, sum(errors), time.perf_counter() - start
+
+
+def report(latencies, errors, elapsed):
+    print('requests : %d (%d errors)' % (len(latencies), errors))
+    print('rps      : %.1f' % (len(latencies) / elapsed))
+    for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+        print('%-9s: %.1f ms' % (name, percentile(latencies, fraction) * 1000))
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:5000/movies'
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    paths = sys.argv[4:]
+    if not TOKEN:
+        sys.exit('set LOAD_TEST_TOKEN to a valid bearer token')
+    urls = [urljoin(url, path) for path in paths] or [url]
+    latencies, errors, elapsed = run(urls, clients, seconds, TOKEN)
+    print('%d clients, %.1fs, %s' % (clients, elapsed, ', '.join(urls)))
+    report(latencies, errors, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import io
+import os
+from datetime import datetime
+from sqlalchemy import insert, delete, select, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+
+from models import db, commit, Role, TableVersion, invalidate, record_roles
+
+'''
+Bulk inserts
+    used by POST /movies/bulk and POST /actors/bulk
+    every item is validated first, the valid rows are then written in one
+    transaction:
+        - PostgreSQL, more than BULK_COPY_THRESHOLD rows: the ids are
+          reserved from the sequence and the rows are sent with COPY
+        - dialects with multi-row RETURNING: INSERT ... VALUES (...), (...)
+          RETURNING id, BULK_CHUNK_SIZE rows per statement
+        - otherwise: the ORM flushes all the rows in one transaction
+'''
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_COPY_THRESHOLD = int(os.environ.get('BULK_COPY_THRESHOLD', 5000))
+
+
+'''
+validate_movie(item) / validate_actor(item)
+    return the row to insert for one item of a bulk request
+    raise a ValueError with the message reported to the client otherwise
+    the release is an ISO date or a MM/DD/YYYY date
+'''
+
+
+def validate_movie(item):
+    if not isinstance(item, dict):
+        raise ValueError('movie must be an object')
+    title = item.get('title')
+    release = item.get('release')
+    if not title or release is None:
+        raise ValueError('title and release are required')
+    if not isinstance(title, str):
+        raise ValueError('title must be a string')
+    return {'title': title, 'release': parse_release(release)}
+
+
+def parse_release(value):
+    if isinstance(value, str):
+        for parse in (datetime.fromisoformat,
+                      lambda value: datetime.strptime(value, '%m/%d/%Y')):
+            try:
+                return parse(value)
+            except ValueError:
+                pass
+    raise ValueError('release must be a date')
+
+
+def validate_actor(item):
+    if not isinstance(item, dict):
+        raise ValueError('actor must be an object')
+    name = item.get('name')
+    age = item.get('age')
+    gender = item.get('gender')
+    if not name or age is None or gender is None:
+        raise ValueError('name, age and gender are required')
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        raise ValueError('age must be an integer')
+    return {'name': name, 'age': age, 'gender': gender}
+
+
+def validate_role(item):
+    if not isinstance(item, dict):
+        raise ValueError('role must be an object')
+    row = {'movie_id': item.get('movie_id'),
+           'actor_id': item.get('actor_id')}
+    # bool is a subclass of int: {"movie_id": true} is not an id, and
+    # 1.5 or "7" are not coerced either
+    for value in row.values():
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError('movie_id and actor_id must be integers')
+    return row
+
+
+'''
+validate_items(items, validate)
+    returns (rows, errors)
+        rows: list of (index, row) of the valid items
+        errors: list of {'index', 'message'} of the invalid ones
+'''
+
+
+def validate_items(items, validate):
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append((index, validate(item)))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+    return rows, errors
+
+
+'''
+bulk_insert(model, rows)
+    inserts the rows (list of dict) in the table of the model
+    returns the ids in the order of the rows
+    the caller commits or rolls back the transaction
+'''
+
+
+def bulk_insert(model, rows):
+    if not rows:
+        return []
+    table = model.__table__
+    connection = db.session.connection()
+    dialect = connection.dialect
+    if dialect.name == 'postgresql' and len(rows) >= BULK_COPY_THRESHOLD:
+        ids = _copy_insert(connection, table, rows)
+    elif getattr(dialect, 'full_returning', False):
+        ids = []
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_CHUNK_SIZE]
+            result = connection.execute(
+                insert(table).values(chunk).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    else:
+        objects = [model(**row) for row in rows]
+        db.session.add_all(objects)
+        db.session.flush()
+        ids = [obj.id for obj in objects]
+    # bumped after the rows: the lock of its table_versions row is held
+    # until the commit, not during the whole load
+    TableVersion.bump(table.name)
+    invalidate(table.name)
+    return ids
+
+
+def insert_one(model, row):
+    table = model.__table__
+    result = db.session.connection().execute(insert(table).values(row))
+    TableVersion.bump(table.name)
+    invalidate(table.name)
+    return result.inserted_primary_key[0]
+
+
+'''
+create_items(model, rows, partial)
+    @INPUTS
+        rows: list of (index, row) returned by validate_items
+        partial: report the rows refused by the database instead of
+            aborting the whole batch
+    inserts the rows and commits
+    returns (created, errors)
+        created: list of (id, row) in the order of the items
+        errors: list of {'index', 'message'}
+    raises the SQLAlchemyError of the batch when partial is False (the
+    errors of COPY are wrapped in a DBAPIError)
+'''
+
+
+def create_items(model, rows, partial=False):
+    try:
+        ids = bulk_insert(model, [row for _, row in rows])
+        commit()
+        return list(zip(ids, [row for _, row in rows])), []
+    except SQLAlchemyError:
+        db.session.rollback()
+        if not partial:
+            raise
+
+    # the batch was refused, retry every row in its own savepoint to
+    # find the faulty ones
+    created = []
+    errors = []
+    for index, row in rows:
+        try:
+            with db.session.begin_nested():
+                created.append((insert_one(model, row), row))
+        except SQLAlchemyError:
+            errors.append({'index': index,
+                           'message': 'rejected by the database'})
+    commit()
+    return created, errors
+
+
+'''
+insert_roles(rows) / delete_roles(rows)
+    @INPUTS
+        rows: list of {'movie_id', 'actor_id'}
+    set based insert (delete) of casting links, BULK_CHUNK_SIZE pairs
+    per statement, the existing pairs are skipped with
+    ON CONFLICT DO NOTHING on uq_roles_movie_actor
+    return the number of inserted (deleted) rows
+    the caller commits or rolls back the transaction
+'''
+
+
+def insert_roles(rows):
+    rows = list({(row['movie_id'], row['actor_id']): row
+                 for row in rows}.values())
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+    table = Role.__table__
+    count = 0
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_CHUNK_SIZE]
+        if dialect in ('postgresql', 'sqlite'):
+            dialect_insert = (postgresql.insert if dialect == 'postgresql'
+                              else sqlite.insert)
+            statement = dialect_insert(table).values(chunk) \
+                .on_conflict_do_nothing(
+                    index_elements=['movie_id', 'actor_id'])
+        else:
+            pairs = [(row['movie_id'], row['actor_id']) for row in chunk]
+            existing = set(connection.execute(
+                select(table.c.movie_id, table.c.actor_id).where(
+                    tuple_(table.c.movie_id, table.c.actor_id).in_(pairs))))
+            chunk = [row for row in chunk
+                     if (row['movie_id'], row['actor_id']) not in existing]
+            if not chunk:
+                continue
+            statement = insert(table).values(chunk)
+        count += connection.execute(statement).rowcount
+    if count:
+        TableVersion.bump('roles')
+        record_roles(added=[(row['movie_id'], row['actor_id'])
+                            for row in rows])
+        invalidate_roles(rows)
+    return count
+
+
+def delete_roles(rows):
+    pairs = list({(row['movie_id'], row['actor_id']) for row in rows})
+    connection = db.session.connection()
+    table = Role.__table__
+    count = 0
+    for start in range(0, len(pairs), BULK_CHUNK_SIZE):
+        count += connection.execute(delete(table).where(
+            tuple_(table.c.movie_id, table.c.actor_id).in_(
+                pairs[start:start + BULK_CHUNK_SIZE]))).rowcount
+    if count:
+        TableVersion.bump('roles')
+        record_roles(removed=pairs)
+        invalidate_roles(rows)
+    return count
+
+
+def invalidate_roles(rows):
+    invalidate('movies', *[
+        tag for row in rows for tag in (f"movie:{row['movie_id']}",
+                                        f"actor:{row['actor_id']}")])
+
+
+'''
+_copy_insert(connection, table, rows)
+    reserves the ids with nextval() and streams the rows with COPY, the
+    fastest way to load a large payload in PostgreSQL
+    raises a DBAPIError when the database refuses a row, like the other
+    statements of the session
+'''
+
+
+def _copy_insert(connection, table, rows):
+    sequence = connection.execute(
+        text('SELECT pg_get_serial_sequence(:table, :column)'),
+        {'table': table.name, 'column': 'id'}).scalar()
+    ids = [row[0] for row in connection.execute(
+        text('SELECT nextval(:sequence) FROM generate_series(1, :count)'),
+        {'sequence': sequence, 'count': len(rows)})]
+
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    for id, row in zip(ids, rows):
+        buffer.write(','.join([str(id)] + [
+            _csv_field(row[column]) for column in columns]) + '\n')
+    buffer.seek(0)
+
+    statement = 'COPY {} (id, {}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ', '.join(columns))
+    dbapi_error = connection.dialect.dbapi.Error
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    except dbapi_error as e:
+        raise DBAPIError.instance(statement, None, e, dbapi_error,
+                                  dialect=connection.dialect)
+    finally:
+        cursor.close()
+    return ids
+
+
+def _csv_field(value):
+    # in the csv format of COPY an unquoted empty field is NULL and a
+    # quoted one is a string, even '' or \N
+    if value is None:
+        return ''
+    return '"%s"' % str(value).replace('"', '""')
@@ -0,0 +1,88 @@
+import time
+import threading
+from collections import OrderedDict
+
+'''
+TTLCache
+    bounded in-process LRU cache with a time to live per entry
+    the least recently used entry is evicted when maxsize is reached
+    hits, misses and evictions are counted for monitoring
+'''
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    '''
+    get(key)
+        returns the cached value or None if missing or expired
+    '''
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self._removed(key, value)
+            self.misses += 1
+            return None
+
+    '''
+    set(key, value, ttl=None)
+        stores the value for ttl seconds (default: the cache ttl)
+    '''
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                self._removed(old_key, old_value)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(key, entry[0])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    '''
+    _removed(key, value)
+        called (with the lock held) when an entry is evicted, expires or
+        is deleted
+    '''
+    def _removed(self, key, value):
+        pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,114 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import request, make_response, g
+
+from models import TableVersion
+
+'''
+Conditional GET
+    every write of movies, actors or roles bumps the version of its table
+    (TableVersion.bump, in the same transaction)
+    a GET route decorated with @conditional(tables) reads the versions of
+    the tables it depends on (one primary key lookup) and
+        - answers 304 Not Modified when If-None-Match matches the ETag or
+          If-Modified-Since is not older than the last write, without
+          querying the rows or serializing json
+        - otherwise runs the route and adds ETag and Last-Modified
+    the ETag also depends on the path, the query string and the Accept
+    header so every page and representation has its own
+    the versions are kept in g.versions_stamp: @cached adds them to its
+    key so a body cached before a write of another worker is never sent
+    with the ETag of the new versions
+    includes: the tables added when the request has ?include=
+@versioned(*tables)
+    only keeps the versions in g.versions_stamp, for the cached routes
+    without ETag (GET /movies/<id>, GET /actors/<id>)
+'''
+
+
+'''
+compute_etag(versions, full_path, accept) / not_modified(etag,
+last_modified, if_none_match, if_modified_since)
+    the request values default to the current flask request, the async
+    reads (asgi.py) pass their own
+    If-None-Match wins over If-Modified-Since when both are sent
+last_modified_of(versions, now)
+    the date of the last write, None while its second is not over: a
+    date has a one second resolution and a second write in the same
+    second would otherwise be hidden by If-Modified-Since (the ETag still
+    answers 304)
+'''
+
+
+def compute_etag(versions, full_path=None, accept=None):
+    if full_path is None:
+        full_path = request.full_path
+        accept = request.headers.get('Accept', '')
+    raw = '%s|%s|%s' % (versions_stamp(versions), full_path, accept or '')
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def versions_stamp(versions):
+    return '|'.join('%s:%s' % (name, versions[name][0])
+                    for name in sorted(versions))
+
+
+def not_modified(etag, last_modified, if_none_match=None,
+                 if_modified_since=None):
+    if if_none_match is None:
+        if_none_match = request.if_none_match
+        if_modified_since = request.if_modified_since
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    if if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= \
+            if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def last_modified_of(versions, now=None):
+    last_modified = max([updated_at for _, updated_at in versions.values()],
+                        default=None)
+    if now is None:
+        now = datetime.utcnow()
+    if last_modified is None or \
+            last_modified.replace(microsecond=0) >= now.replace(microsecond=0):
+        return None
+    return last_modified
+
+
+def conditional(*tables, includes=()):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = tables
+            if request.args.get('include'):
+                names = tables + tuple(includes)
+            versions = TableVersion.current(*names)
+            g.versions_stamp = versions_stamp(versions)
+            etag = compute_etag(versions)
+            last_modified = last_modified_of(versions)
+
+            if not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
+
+
+def versioned(*tables):
+    def versioned_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.versions_stamp = versions_stamp(TableVersion.current(*tables))
+            return f(*args, **kwargs)
+        return wrapper
+    return versioned_decorator
@@ -0,0 +1,51 @@
+import os
+from flask import Response, stream_with_context
+
+from json_provider import dumps
+
+'''
+Streaming export
+    with the header Accept: application/x-ndjson the list endpoints send
+    the whole table as newline delimited json, one object per line
+    the rows are read from a server side cursor in batches of
+    EXPORT_BATCH_SIZE (yield_per) and written by a generator so the
+    memory stays constant whatever the size of the table
+'''
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+
+def wants_ndjson(request):
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+'''
+ndjson_response(query, serialize)
+    @INPUTS
+        query: the ordered query of the rows to export
+        serialize: function returning the list of dicts of a batch of rows
+            (e.g. queries.MOVIES.serialize)
+    returns a streamed response
+'''
+
+
+def ndjson_response(query, serialize):
+    rows = query.execution_options(stream_results=True).yield_per(
+        EXPORT_BATCH_SIZE)
+
+    def generate():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == EXPORT_BATCH_SIZE:
+                yield b''.join(dumps(item) + b'\n'
+                               for item in serialize(batch))
+                batch = []
+        if batch:
+            yield b''.join(dumps(item) + b'\n' for item in serialize(batch))
+
+    return Response(stream_with_context(generate()),
+                    mimetype=NDJSON_MIMETYPE)
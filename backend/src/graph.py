@@ -0,0 +1,323 @@
+import os
+import time
+import logging
+import threading
+from array import array
+
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+
+from models import db, Role, TableVersion
+
+'''
+Co-star graph
+    used by GET /actors/<id>/costars and GET /actors/<a>/path/<b>
+    the roles are held in memory as two CSR indexes (compressed sparse
+    rows: integer arrays of offsets and targets indexed by id):
+        - actor id -> ids of the movies of the actor
+        - movie id -> ids of the actors of the movie
+    the co-stars of an actor are the actors of its movies, the degrees of
+    separation are found with a bidirectional breadth first search
+    the index is built for the version of the 'roles' table
+    (TableVersion):
+        - the role writes of this worker record their pairs
+          (models.record_roles), they are applied after the commit as a
+          small overlay on top of the arrays
+        - any other change of the version (other workers, ORM updates)
+          rebuilds the index at the next query, so does an overlay larger
+          than GRAPH_MAX_PATCHES
+    the version is read at most every GRAPH_CHECK_SECONDS: the writes of
+    the other workers show up after this delay
+    the arrays are built outside of the lock of the graph and swapped in,
+    the queries and the patches of the commits never wait for a build
+'''
+
+GRAPH_MAX_PATCHES = int(os.environ.get('GRAPH_MAX_PATCHES', 10000))
+GRAPH_CHECK_SECONDS = float(os.environ.get('GRAPH_CHECK_SECONDS', 1))
+GRAPH_MAX_DEPTH = int(os.environ.get('GRAPH_MAX_DEPTH', 6))
+
+logger = logging.getLogger(__name__)
+
+
+'''
+build_csr(rows)
+    @INPUTS
+        rows: (source id, target id) pairs ordered by source id
+    returns (offsets, targets): the targets of a source are
+    targets[offsets[source]:offsets[source + 1]]
+'''
+
+
+def build_csr(rows):
+    counts = array('l')
+    targets = array('l')
+    for source, target in rows:
+        if source >= len(counts):
+            counts.extend([0] * (source + 1 - len(counts)))
+        counts[source] += 1
+        targets.append(target)
+    offsets = array('l', [0]) * (len(counts) + 1)
+    for source, count in enumerate(counts):
+        offsets[source + 1] = offsets[source] + count
+    return offsets, targets
+
+
+def csr_row(csr, source):
+    offsets, targets = csr
+    if source < 0 or source + 1 >= len(offsets):
+        return ()
+    return targets[offsets[source]:offsets[source + 1]]
+
+
+def csr_bytes(csr):
+    return sum(len(part) * part.itemsize for part in csr)
+
+
+class CoStarGraph:
+    def __init__(self, check_seconds=GRAPH_CHECK_SECONDS):
+        self.lock = threading.Lock()
+        # one build at a time
+        self.build_lock = threading.Lock()
+        self.check_seconds = check_seconds
+        self.checked_at = None
+        self.version = None
+        self.actor_movies = (array('l', [0]), array('l'))
+        self.movie_actors = (array('l', [0]), array('l'))
+        # overlay of the pairs written since the build
+        self.added_by_actor = {}
+        self.added_by_movie = {}
+        self.removed = set()
+        self.patches = 0
+        # calls of patch(), a build started before one is stale
+        self.writes = 0
+        self.build_seconds = 0.0
+        self.built_at = None
+        self.builds = 0
+
+    '''
+    refresh()
+        rebuilds the index if the version of the roles moved since the
+        build (and the patches) or the overlay is too large
+    '''
+    def refresh(self):
+        now = time.monotonic()
+        if (not self.stale(self.version) and self.checked_at is not None
+                and now - self.checked_at < self.check_seconds):
+            return
+        current = TableVersion.current('roles').get('roles')
+        version = current[0] if current else 0
+        if self.stale(version):
+            with self.build_lock:
+                # built by another thread while this one waited
+                if self.stale(version):
+                    self._build(version)
+        self.checked_at = now
+
+    def stale(self, version):
+        return (version is None or self.version != version or
+                self.patches > GRAPH_MAX_PATCHES)
+
+    def _build(self, version):
+        start = time.perf_counter()
+        writes = self.writes
+        actor_movies = build_csr(db.session.execute(
+            select(Role.actor_id, Role.movie_id)
+            .where(Role.actor_id.isnot(None), Role.movie_id.isnot(None))
+            .order_by(Role.actor_id, Role.movie_id)
+            .execution_options(stream_results=True)))
+        movie_actors = build_csr(db.session.execute(
+            select(Role.movie_id, Role.actor_id)
+            .where(Role.actor_id.isnot(None), Role.movie_id.isnot(None))
+            .order_by(Role.movie_id, Role.actor_id)
+            .execution_options(stream_results=True)))
+        with self.lock:
+            self.actor_movies = actor_movies
+            self.movie_actors = movie_actors
+            self.added_by_actor = {}
+            self.added_by_movie = {}
+            self.removed = set()
+            self.patches = 0
+            # a commit patched during the build may be missing from the
+            # arrays: rebuilt at the next query
+            self.version = version if self.writes == writes else None
+            self.build_seconds = time.perf_counter() - start
+            self.built_at = time.time()
+            self.builds += 1
+        logger.info('co-star graph %s built in %.3fs, %d roles, %d bytes',
+                    version, self.build_seconds, len(actor_movies[1]),
+                    self.memory_bytes())
+
+    '''
+    patch(from_version, to_version, changes)
+        applies the (added, removed) pairs committed by this worker
+        the index is only patched if it was at from_version, it is marked
+        stale otherwise (or if changes is None: unknown writes) and
+        rebuilt at the next query
+    '''
+    def patch(self, from_version, to_version, changes):
+        with self.lock:
+            self.writes += 1
+            if changes is None or self.version != from_version:
+                self.version = None
+                return
+            for added, removed in changes:
+                for movie_id, actor_id in added:
+                    self.removed.discard((movie_id, actor_id))
+                    self.added_by_actor.setdefault(
+                        actor_id, set()).add(movie_id)
+                    self.added_by_movie.setdefault(
+                        movie_id, set()).add(actor_id)
+                for movie_id, actor_id in removed:
+                    self.added_by_actor.get(actor_id, set()).discard(
+                        movie_id)
+                    self.added_by_movie.get(movie_id, set()).discard(
+                        actor_id)
+                    self.removed.add((movie_id, actor_id))
+                self.patches += len(added) + len(removed)
+            self.version = to_version
+
+    def movies_of(self, actor_id):
+        movies = set(csr_row(self.actor_movies, actor_id))
+        movies |= self.added_by_actor.get(actor_id, set())
+        if self.removed:
+            movies = {movie_id for movie_id in movies
+                      if (movie_id, actor_id) not in self.removed}
+        return movies
+
+    def actors_of(self, movie_id):
+        actors = set(csr_row(self.movie_actors, movie_id))
+        actors |= self.added_by_movie.get(movie_id, set())
+        if self.removed:
+            actors = {actor_id for actor_id in actors
+                      if (movie_id, actor_id) not in self.removed}
+        return actors
+
+    '''
+    costars(actor_id)
+        returns the sorted ids of the actors sharing a movie with the actor
+    '''
+    def costars(self, actor_id):
+        costars = set()
+        for movie_id in self.movies_of(actor_id):
+            costars |= self.actors_of(movie_id)
+        costars.discard(actor_id)
+        return sorted(costars)
+
+    '''
+    path(source, target, max_depth)
+        returns (actor ids, movie ids) of a shortest chain of co-stars
+        from source to target, movies[i] links actors[i] and actors[i + 1]
+        or None if they are not connected within max_depth movies
+        the smaller frontier is expanded first and every movie is
+        expanded once per side
+    '''
+    def path(self, source, target, max_depth=GRAPH_MAX_DEPTH):
+        if source == target:
+            return [source], []
+        # actor id -> (previous actor id, movie id, depth)
+        parents = [{source: None}, {target: None}]
+        frontiers = [[source], [target]]
+        expanded = [set(), set()]
+        depths = [0, 0]
+        while frontiers[0] and frontiers[1] and sum(depths) < max_depth:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            own, other = parents[side], parents[1 - side]
+            depths[side] += 1
+            meetings = []
+            frontier = []
+            for actor_id in frontiers[side]:
+                for movie_id in self.movies_of(actor_id):
+                    if movie_id in expanded[side]:
+                        continue
+                    expanded[side].add(movie_id)
+                    for costar in self.actors_of(movie_id):
+                        if costar in own:
+                            continue
+                        own[costar] = (actor_id, movie_id, depths[side])
+                        if costar in other:
+                            meetings.append(costar)
+                        frontier.append(costar)
+            frontiers[side] = frontier
+            if meetings:
+                # the meeting closest to the other end is the shortest
+                meeting = min(meetings, key=lambda actor_id: (
+                    other[actor_id][2] if other[actor_id] else 0))
+                return self._chain(parents, meeting)
+        return None
+
+    def _chain(self, parents, meeting):
+        actors = [meeting]
+        movies = []
+        actor_id = meeting
+        while parents[0][actor_id] is not None:
+            actor_id, movie_id, _ = parents[0][actor_id]
+            actors.insert(0, actor_id)
+            movies.insert(0, movie_id)
+        actor_id = meeting
+        while parents[1][actor_id] is not None:
+            actor_id, movie_id, _ = parents[1][actor_id]
+            actors.append(actor_id)
+            movies.append(movie_id)
+        return actors, movies
+
+    def memory_bytes(self):
+        overlay = sum(len(movies) for movies in self.added_by_actor.values())
+        overlay += sum(len(actors) for actors in self.added_by_movie.values())
+        # the overlay is estimated at ~64 bytes per entry of a set
+        return (csr_bytes(self.actor_movies) + csr_bytes(self.movie_actors) +
+                64 * (overlay + len(self.removed)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'roles': len(self.actor_movies[1]),
+                'patches': self.patches,
+                'builds': self.builds,
+                'build_seconds': self.build_seconds,
+                'built_at': self.built_at,
+                'memory_bytes': self.memory_bytes()
+                }
+
+
+costar_graph = CoStarGraph()
+
+
+'''
+the version of the roles is read before the commit (the row of
+table_versions is locked by the transaction which bumped it) so the patch
+knows the version it applies to
+'''
+
+
+@event.listens_for(Session, 'before_commit')
+def read_roles_version(session):
+    if session.in_nested_transaction():
+        return
+    bumps = session.info.get('bumps', {}).get('roles', 0)
+    if not bumps:
+        return
+    changes = session.info.get('roles_changes', [])
+    version = session.execute(
+        select(TableVersion.version).where(TableVersion.name == 'roles')
+        ).scalar()
+    if version is None:
+        return
+    session.info['roles_patch'] = (
+        version - bumps, version,
+        changes if len(changes) == bumps else None)
+
+
+@event.listens_for(Session, 'after_commit')
+def patch_after_commit(session):
+    if session.in_nested_transaction():
+        return
+    patch = session.info.pop('roles_patch', None)
+    if patch is not None:
+        costar_graph.patch(*patch)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_patch(session):
+    if not session.in_nested_transaction():
+        session.info.pop('roles_patch', None)
@@ -0,0 +1,33 @@
+import os
+import multiprocessing
+
+'''
+gunicorn settings, used by the Procfile: gunicorn -c gunicorn.conf.py
+    WEB_CONCURRENCY: number of worker processes, default 2 * cpus + 1
+    GUNICORN_THREADS: threads per worker (gthread), default 4. Keep
+        DB_POOL_SIZE + DB_MAX_OVERFLOW >= threads so a thread never waits
+        for a connection
+    GUNICORN_TIMEOUT: seconds before a silent worker is restarted
+    GUNICORN_WORKER_CLASS: e.g. uvicorn.workers.UvicornWorker to serve the
+        async mode (asgi:app), default gthread (sync with one thread)
+    the application is imported once in the master (preload_app) and the
+    workers are forked from it: the engine is disposed after the fork so
+    each worker opens its own connections
+'''
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS',
+                              'gthread' if threads > 1 else 'sync')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def post_fork(server, worker):
+    from app import app
+    from models import dispose_engine
+    with app.app_context():
+        dispose_engine()
@@ -0,0 +1,82 @@
+import os
+import json
+from datetime import date, datetime
+from flask import current_app
+
+from metrics import timed
+
+'''
+JSON provider
+    serializes the api responses straight to bytes
+        OrjsonProvider: orjson (rust), used when the package is installed
+        StdlibProvider: the json module of the standard library
+    JSON_BACKEND=orjson|stdlib forces one of them
+    both write compact utf-8 json and the DateTime columns (release) as
+    ISO 8601 strings, the output is the same whatever the backend
+'''
+
+JSON_BACKEND = os.environ.get('JSON_BACKEND')
+
+
+def _default(obj):
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} '
+                    'is not JSON serializable')
+
+
+class StdlibProvider:
+    name = 'stdlib'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=_default, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonProvider:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self._dumps(obj, default=_default, option=self._option)
+
+
+def create_provider(backend=JSON_BACKEND):
+    if backend == 'stdlib':
+        return StdlibProvider()
+    try:
+        return OrjsonProvider()
+    except ImportError:
+        if backend == 'orjson':
+            raise
+        return StdlibProvider()
+
+
+json_provider = create_provider()
+
+
+def dumps(obj):
+    with timed('serialize'):
+        return json_provider.dumps(obj)
+
+
+'''
+jsonify(*args, **kwargs)
+    same signature as flask.jsonify, the body is written by json_provider
+'''
+
+
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both '
+                        'args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return current_app.response_class(dumps(data) + b'\n',
+                                      mimetype='application/json')
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import logging
+import threading
+from urllib.request import urlopen
+from jose import jwk
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSStore
+    in-process store of the JSON Web Key Set published by Auth0
+
+    the keys are held in memory and indexed by key id (kid):
+        - they are refreshed in a background thread every refresh_interval
+        - an unknown kid triggers an immediate refresh, at most once every
+          min_refresh_interval seconds so that garbage tokens can not be
+          used to hammer the identity provider
+        - when the provider is down the last known keys are served
+        - a ready to use verifier (jose Key object) is built once per kid
+          when the key set is loaded instead of once per decoded token
+        - the store can be seeded from a local jwks.json file; without an
+          url the store never goes to the network (tests, benchmarks)
+'''
+
+
+class JWKSStore:
+    def __init__(self, url=None, path=None, refresh_interval=600,
+                 min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._verifiers = {}
+        self._loaded_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        if path:
+            self.load_file(path)
+
+    '''
+    load_file(path)
+        seeds the store from a local jwks.json file
+    '''
+    def load_file(self, path):
+        with open(path) as f:
+            self.load(json.load(f))
+
+    '''
+    load(jwks)
+        replaces the keys with the content of a decoded jwks document
+        and builds the verifier of every key
+    '''
+    def load(self, jwks):
+        keys = {key['kid']: key for key in jwks.get('keys', [])
+                if 'kid' in key}
+        verifiers = {}
+        for kid, key in keys.items():
+            try:
+                verifiers[kid] = jwk.construct(key, key.get('alg', 'RS256'))
+            except Exception as e:
+                logger.warning('Unable to build the key %s: %s', kid, e)
+        self._keys, self._verifiers = keys, verifiers
+        self._loaded_at = time.monotonic()
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    '''
+    refresh(force=False)
+        fetches the key set from the provider
+        returns True if new keys were loaded
+        failures are logged and the stale keys are kept
+    '''
+    def refresh(self, force=False):
+        if not self.url:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if (not force and self._attempted_at is not None and
+                    now - self._attempted_at < self.min_refresh_interval):
+                return False
+            self._attempted_at = now
+            try:
+                jwks = self.fetch()
+            except Exception as e:
+                logger.warning('JWKS refresh from %s failed: %s', self.url, e)
+                return False
+            self.load(jwks)
+            return True
+
+    def is_stale(self):
+        return (self._loaded_at is None or
+                time.monotonic() - self._loaded_at > self.refresh_interval)
+
+    '''
+    get_key(kid)
+        returns the jwk for the key id or None if it is unknown
+    '''
+    def get_key(self, kid):
+        return self._lookup(kid, lambda: self._keys)
+
+    '''
+    get_verifier(kid)
+        returns the prebuilt jose Key object for the key id or None
+    '''
+    def get_verifier(self, kid):
+        return self._lookup(kid, lambda: self._verifiers)
+
+    def _lookup(self, kid, table):
+        self.start_background_refresh()
+        if self.is_stale():
+            self.refresh()
+        value = table().get(kid)
+        if value is None and self.refresh():
+            value = table().get(kid)
+        return value
+
+    def has_keys(self):
+        return bool(self._keys)
+
+    '''
+    start_background_refresh()
+        starts the refresh thread once per process
+        gunicorn forks the workers after import, threads do not survive
+        the fork so the pid is checked on every call
+    '''
+    def start_background_refresh(self):
+        if not self.url or self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            thread = threading.Thread(target=self._refresh_loop,
+                                      name='jwks-refresh', daemon=True)
+            thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh(force=True)
@@ -0,0 +1,266 @@
+import os
+import hmac
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+'''
+Metrics
+    per request timings and Prometheus metrics of the worker
+        - latency of every route (histogram by method, route and status)
+        - time spent in auth (token check), pool (wait for a connection),
+          db (SQL statements) and serialize (json encoding), and number of
+          SQL queries per request
+        - duration of every SQL statement and wait for a pooled connection
+    every response carries the timings of its request in a Server-Timing
+    header (shown by the network panel of the browsers), e.g.
+        Server-Timing: auth;dur=0.4, pool;dur=0.1,
+                       db;dur=2.1;desc="3 queries", serialize;dur=0.2,
+                       total;dur=3.5
+    GET /metrics returns the metrics in the Prometheus text format, with
+    the bearer METRICS_TOKEN (for the scraper) or a token with get:movies
+    the timings of the current request live in a context variable: the
+    threads of gthread and the coroutines of the async mode (asgi.py) each
+    see their own
+    every gunicorn worker has its own registry, Prometheus sums the
+    workers of a target when they are scraped one by one
+'''
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+PHASES = ('auth', 'pool', 'db', 'serialize')
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [counts per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count)
+                            in self.series.items())
+        for labels, (counts, total, count) in series:
+            pairs = ['%s="%s"' % (name, escape(value))
+                     for name, value in zip(self.labels, labels)]
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket{%s} %d' % (self.name, ','.join(
+                    pairs + ['le="%s"' % format_bound(bound)]), cumulative))
+            lines.append('%s_bucket{%s} %d' % (
+                self.name, ','.join(pairs + ['le="+Inf"']), count))
+            suffix = '{%s}' % ','.join(pairs) if pairs else ''
+            lines.append('%s_sum%s %r' % (self.name, suffix, total))
+            lines.append('%s_count%s %d' % (self.name, suffix, count))
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_bound(bound):
+    return ('%f' % bound).rstrip('0').rstrip('.') or '0'
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Latency of the requests',
+    ('method', 'route', 'status'))
+phase_duration = Histogram(
+    'http_request_phase_seconds',
+    'Time of a request spent in auth, pool, db and serialize',
+    ('route', 'phase'))
+request_queries = Histogram(
+    'db_queries_per_request', 'SQL statements run by a request', ('route',),
+    QUERY_BUCKETS)
+query_duration = Histogram(
+    'db_query_duration_seconds', 'Duration of the SQL statements')
+pool_wait = Histogram(
+    'db_pool_checkout_seconds',
+    'Wait for a connection of the pool (including a new connection)')
+
+HISTOGRAMS = [request_duration, phase_duration, request_queries,
+              query_duration, pool_wait]
+
+# name -> (help, function returning the value)
+gauges = {}
+
+
+def register_gauge(name, help, value):
+    gauges[name] = (help, value)
+
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, (help, value) in sorted(gauges.items()):
+        try:
+            current = value()
+        except Exception:
+            continue
+        if current is None:
+            continue
+        lines.extend(['# HELP %s %s' % (name, help),
+                      '# TYPE %s gauge' % name,
+                      '%s %r' % (name, current)])
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+
+current_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    current_timings.set(RequestTimings())
+
+
+'''
+add_time(phase, seconds)
+    adds to a phase of the current request (nothing outside a request)
+timed(phase)
+    context manager timing its block into the phase
+'''
+
+
+def add_time(phase, seconds):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.phases[phase] += seconds
+
+
+class timed:
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        add_time(self.phase, time.perf_counter() - self.start)
+
+
+'''
+finish_request(method, route, status)
+    records the metrics of the current request and returns the value of
+    its Server-Timing header (None outside a request)
+'''
+
+
+def finish_request(method, route, status):
+    timings = current_timings.get()
+    if timings is None:
+        return None
+    current_timings.set(None)
+    total = time.perf_counter() - timings.start
+    request_duration.observe(total, method, route, str(status))
+    for phase, seconds in timings.phases.items():
+        phase_duration.observe(seconds, route, phase)
+    request_queries.observe(timings.queries, route)
+    entries = []
+    for phase, seconds in timings.phases.items():
+        entry = '%s;dur=%.1f' % (phase, seconds * 1000)
+        if phase == 'db':
+            entry += ';desc="%d queries"' % timings.queries
+        entries.append(entry)
+    entries.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(entries)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    query_duration.observe(seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.phases['db'] += seconds
+        timings.queries += 1
+
+
+'''
+TimedQueuePool
+    the pool of the server databases (models.engine_options), times the
+    checkout of every connection
+'''
+
+
+class TimedQueuePool(QueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            seconds = time.perf_counter() - start
+            pool_wait.observe(seconds)
+            add_time('pool', seconds)
+
+
+'''
+init_metrics(app)
+    adds the timing hooks to the flask app
+'''
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_timings():
+        start_request()
+
+    @app.after_request
+    def record_timings(response):
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        server_timing = finish_request(request.method, rule,
+                                       response.status_code)
+        if server_timing is not None:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+
+def metrics_token_valid(header):
+    return bool(METRICS_TOKEN and header and hmac.compare_digest(
+        header.encode('utf-8'), ('Bearer ' + METRICS_TOKEN).encode('utf-8')))
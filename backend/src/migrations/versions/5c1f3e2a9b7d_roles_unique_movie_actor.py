@@ -0,0 +1,42 @@
+"""unique casting link per movie and actor
+
+Revision ID: 5c1f3e2a9b7d
+Revises: 192b096627c4
+Create Date: 2026-10-18 09:12:40.118201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f3e2a9b7d'
+down_revision = '192b096627c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest role of the duplicated (movie_id, actor_id) pairs
+    op.execute(
+        'DELETE FROM roles WHERE id NOT IN '
+        '(SELECT MIN(id) FROM roles GROUP BY movie_id, actor_id)')
+
+    if op.get_context().dialect.name == 'postgresql':
+        # build the unique index without locking the table, then turn it
+        # into the constraint (instant)
+        with op.get_context().autocommit_block():
+            op.create_index('uq_roles_movie_actor', 'roles',
+                            ['movie_id', 'actor_id'], unique=True,
+                            postgresql_concurrently=True)
+        op.execute('ALTER TABLE roles ADD CONSTRAINT uq_roles_movie_actor '
+                   'UNIQUE USING INDEX uq_roles_movie_actor')
+    else:
+        with op.batch_alter_table('roles') as batch_op:
+            batch_op.create_unique_constraint('uq_roles_movie_actor',
+                                              ['movie_id', 'actor_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('roles') as batch_op:
+        batch_op.drop_constraint('uq_roles_movie_actor', type_='unique')
@@ -0,0 +1,50 @@
+"""indexes of the casting joins and of the lookup columns
+
+Revision ID: 8e4b7d21c6fa
+Revises: 5c1f3e2a9b7d
+Create Date: 2026-10-18 10:03:52.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b7d21c6fa'
+down_revision = '5c1f3e2a9b7d'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns)
+# the (movie_id, actor_id) direction of roles is served by the unique
+# index uq_roles_movie_actor of the previous revision
+INDEXES = [
+    ('ix_roles_actor_id_movie_id', 'roles', ['actor_id', 'movie_id']),
+    ('ix_movies_title', 'movies', ['title']),
+    ('ix_movies_release', 'movies', ['release']),
+    ('ix_actors_name', 'actors', ['name']),
+]
+
+
+def upgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY does not lock the tables against
+        # writes but can not run inside a transaction
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns,
+                                postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, _ in reversed(INDEXES):
+                op.drop_index(name, table_name=table,
+                              postgresql_concurrently=True)
+    else:
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,35 @@
+"""write counters of the tables for the conditional GET
+
+Revision ID: b37a90d4e5c1
+Revises: 8e4b7d21c6fa
+Create Date: 2026-10-18 11:26:07.342881
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b37a90d4e5c1'
+down_revision = '8e4b7d21c6fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(length=40), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 1, 'updated_at': now}
+        for name in ('movies', 'actors', 'roles')])
+
+
+def downgrade():
+    op.drop_table('table_versions')
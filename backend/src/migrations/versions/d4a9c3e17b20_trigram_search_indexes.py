@@ -0,0 +1,45 @@
+"""trigram indexes of the title and name searches
+
+Revision ID: d4a9c3e17b20
+Revises: b37a90d4e5c1
+Create Date: 2026-10-18 14:12:40.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a9c3e17b20'
+down_revision = 'b37a90d4e5c1'
+branch_labels = None
+depends_on = None
+
+# (name, table, column)
+# ?q= is compiled to ILIKE '%q%' which a GIN gin_trgm_ops index serves,
+# other dialects keep the plain index of the previous revisions
+INDEXES = [
+    ('ix_movies_title_trgm', 'movies', 'title'),
+    ('ix_actors_name_trgm', 'actors', 'name'),
+]
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.create_index(name, table, [column],
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -1,17 +1,97 @@
 import os
 from datetime import datetime
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, select, inspect
 from sqlalchemy.sql.expression import null
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.engine import Engine
 import json
 
+from response_cache import response_cache
+from replicas import REPLICA_URLS, ReplicaSet, reads_from_replica, detach_pool
+from metrics import TimedQueuePool
+
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
     database_path = database_path.replace("postgres://", "postgresql://", 1)
 
 
-db = SQLAlchemy()
+'''
+RoutingSession
+    session of the requests, reads a GET request from a replica (see
+    replicas.py) until its first write
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['primary'] = True
+        if not self.info.get('primary'):
+            if 'replica' not in self.info:
+                self.info['replica'] = (
+                    replica_set.choose(self.bind)
+                    if reads_from_replica() else None)
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+PGBOUNCER = env_flag('PGBOUNCER')
+STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+
+'''
+engine_options(database_path)
+    options of the engine read from the environment:
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT: connections kept
+            open per worker, extra connections under load, seconds to wait
+            for a free one
+        DB_POOL_RECYCLE: seconds after which a connection is replaced
+        DB_POOL_PRE_PING: test the connection before using it
+        DB_STATEMENT_TIMEOUT_MS: PostgreSQL statement_timeout (0: none)
+        the checkouts of the pool are timed (metrics.TimedQueuePool)
+        PGBOUNCER: the server is a PgBouncer in transaction pooling mode,
+            no session state survives a transaction: the timeout is set
+            per transaction (psycopg2 never prepares statements on the
+            server)
+    the pool sizes only apply to the server databases (not SQLite)
+'''
+
+
+def engine_options(database_path):
+    options = {
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+    }
+    if database_path.startswith('sqlite'):
+        return options
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    })
+    if STATEMENT_TIMEOUT_MS and not PGBOUNCER:
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % STATEMENT_TIMEOUT_MS}
+    return options
 
 '''
 setup_db(app)
@@ -22,10 +102,130 @@ setup_db(app)
 def setup_db(app, database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
     # db_drop_and_create_all()
 
+'''
+dispose_engine()
+    drops the connections inherited from the parent process, called by
+    gunicorn in every worker after the fork (gunicorn.conf.py) so two
+    processes never share a socket
+'''
+
+
+def dispose_engine():
+    detach_pool(db.get_engine())
+    replica_set.dispose()
+
+
+'''
+with PgBouncer the statement_timeout can not be a startup parameter of the
+connection, it is set at the start of every transaction instead
+'''
+
+
+@event.listens_for(Engine, 'begin')
+def set_statement_timeout(connection):
+    if (PGBOUNCER and STATEMENT_TIMEOUT_MS and
+            connection.dialect.name == 'postgresql'):
+        connection.exec_driver_sql(
+            'SET LOCAL statement_timeout = %d' % STATEMENT_TIMEOUT_MS)
+
+
+'''
+invalidate(*tags)
+    records the response cache tags changed by the current transaction
+    (e.g. 'movies', 'movie:1'), the cached responses carrying them are
+    deleted after the commit, nothing happens on rollback
+'''
+
+
+def invalidate(*tags):
+    db.session.info.setdefault('cache_tags', set()).update(tags)
+
+
+'''
+record_roles(added=(), removed=())
+    records the (movie_id, actor_id) pairs cast (uncast) by the current
+    transaction, called once with each TableVersion.bump('roles') so the
+    co-star graph can be patched after the commit instead of rebuilt
+'''
+
+
+def record_roles(added=(), removed=()):
+    db.session.info.setdefault('roles_changes', []).append(
+        (list(added), list(removed)))
+
+
+'''
+cast_changed(obj, relationship) / cast_deleted(pairs)
+    return ('roles',) when the write of a movie (actor) changes casting
+    links, () otherwise, to be added to the tables bumped with it
+    cast_changed looks at the pending changes of the collection (their
+    pairs are only known after the flush, the co-star graph is rebuilt)
+    cast_deleted records the pairs of a deleted movie (actor)
+'''
+
+
+def cast_changed(obj, relationship):
+    if inspect(obj).attrs[relationship].history.has_changes():
+        return ('roles',)
+    return ()
+
+
+def cast_deleted(pairs):
+    if not pairs:
+        return ()
+    record_roles(removed=pairs)
+    return ('roles',)
+
+
+# the savepoints (begin_nested) fire the commit and rollback events too,
+# only the outermost transaction counts
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_after_commit(session):
+    if session.in_nested_transaction():
+        return
+    if session.info.pop('bumps', None):
+        replica_set.record_write()
+    session.info.pop('roles_changes', None)
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        response_cache.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_after_rollback(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop('bumps', None)
+    session.info.pop('roles_changes', None)
+    session.info.pop('cache_tags', None)
+    if session.info.get('batch'):
+        # the writes of the atomic batch before this point are lost
+        session.info['batch_failed'] = True
+
+
+'''
+commit()
+    commits the current transaction, used by the routes instead of
+    db.session.commit()
+    inside an atomic POST /batch (session.info['batch']) it only flushes,
+    the batch commits or rolls back all its operations at the end
+'''
+
+
+def commit():
+    if db.session.info.get('batch'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
 '''
 db_drop_and_create_all()
     drops the database tables and starts fresh
@@ -38,6 +238,9 @@ db_drop_and_create_all()
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    TableVersion.seed('movies', 'actors', 'roles')
+    db.session.commit()
+    response_cache.backend.clear()
     # add one demo row which is helping in POSTMAN test
     movie1 = Movie(title='Big Blue')
     movie1.insert()
@@ -64,6 +267,7 @@ TABLES
 Movies with attributes title and release date
 Actors with attributes name, gender
 Roles associates actors with movies
+TableVersions counts the writes of each of these tables
 '''
 
 
@@ -71,8 +275,8 @@ Roles associates actors with movies
 class Movie(db.Model):
     __tablename__ = 'movies'
     id = Column(db.Integer, primary_key=True)
-    title = Column(db.String(80))
-    release = Column(db.DateTime, default=datetime.utcnow)
+    title = Column(db.String(80), index=True)
+    release = Column(db.DateTime, default=datetime.utcnow, index=True)
     actors = db.relationship('Actor',
                              secondary="roles",
                              back_populates="movies")
@@ -100,15 +304,20 @@ class Movie(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        TableVersion.bump('movies', *cast_changed(self, 'actors'))
+        invalidate('movies')
+        commit()
 
     '''
     delete()
         deletes a new model into a database
     '''
     def delete(self):
+        pairs = [(self.id, actor.id) for actor in self.actors]
         db.session.delete(self)
-        db.session.commit()
+        TableVersion.bump('movies', *cast_deleted(pairs))
+        invalidate('movies', f'movie:{self.id}')
+        commit()
 
     '''
     update()
@@ -120,13 +329,15 @@ class Movie(db.Model):
             movie.update()
     '''
     def update(self):
-        db.session.commit()
+        TableVersion.bump('movies', *cast_changed(self, 'actors'))
+        invalidate('movies', f'movie:{self.id}')
+        commit()
 
 
 class Actor(db.Model):
     __tablename__ = "actors"
     id = Column(db.Integer, primary_key=True)
-    name = Column(db.String, nullable=False)
+    name = Column(db.String, nullable=False, index=True)
     age = Column(db.Integer)
     gender = Column(db.String)
     movies = db.relationship('Movie',
@@ -153,20 +364,27 @@ class Actor(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        TableVersion.bump('actors', *cast_changed(self, 'movies'))
+        invalidate('actors')
+        commit()
 
     '''
     delete(): deletes a new model into a database
     '''
     def delete(self):
+        pairs = [(movie.id, self.id) for movie in self.movies]
         db.session.delete(self)
-        db.session.commit()
+        TableVersion.bump('actors', *cast_deleted(pairs))
+        invalidate('actors', 'movies', f'actor:{self.id}')
+        commit()
 
     '''
     update(): updates a new model into a database
     '''
     def update(self):
-        db.session.commit()
+        TableVersion.bump('actors', *cast_changed(self, 'movies'))
+        invalidate('actors', 'movies', f'actor:{self.id}')
+        commit()
 
 
 class Role(db.Model):
@@ -175,6 +393,15 @@ class Role(db.Model):
     __mapper_args__ = {
         'confirm_deleted_rows': False
     }
+    # an actor is cast once per movie, the bulk inserts of /roles rely on
+    # this constraint (ON CONFLICT DO NOTHING)
+    # its index serves the joins from the movies, ix_roles_actor_id_movie_id
+    # the joins from the actors
+    __table_args__ = (
+        db.UniqueConstraint('movie_id', 'actor_id',
+                            name='uq_roles_movie_actor'),
+        db.Index('ix_roles_actor_id_movie_id', 'actor_id', 'movie_id'),
+    )
 
     id = Column(db.Integer, primary_key=True)
     movie_id = Column(db.Integer, db.ForeignKey('movies.id'))
@@ -199,17 +426,102 @@ class Role(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        TableVersion.bump('roles')
+        record_roles(added=[(self.movie_id, self.actor_id)])
+        invalidate('movies', f'movie:{self.movie_id}',
+                   f'actor:{self.actor_id}')
+        commit()
 
     '''
     delete(): deletes a new model into a database
     '''
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        TableVersion.bump('roles')
+        record_roles(removed=[(self.movie_id, self.actor_id)])
+        invalidate('movies', f'movie:{self.movie_id}',
+                   f'actor:{self.actor_id}')
+        commit()
 
     '''
     update(): updates a new model into a database
     '''
     def update(self):
-        db.session.commit()
+        TableVersion.bump('roles')
+        invalidate('movies', f'movie:{self.movie_id}',
+                   f'actor:{self.actor_id}')
+        commit()
+
+
+class TableVersion(db.Model):
+    __tablename__ = "table_versions"
+
+    name = Column(db.String(40), primary_key=True)
+    version = Column(db.Integer, nullable=False, default=0)
+    updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<TableVersion {self.name} {self.version}>"
+
+    '''
+    bump(*names): increments the version of the tables in the current
+    transaction, the caller commits
+    the number of bumps per table is kept in session.info['bumps']
+    every write of a table updates the same row of table_versions: its
+    row lock is held until the commit, so the writes of one table are
+    serialized from their bump to their commit (the reads never wait)
+    bump as late as possible in the transaction, right before the commit
+    the rows are never inserted here: two transactions could both miss a
+    row and the second insert would fail, a missing row is a setup error
+    (the migration and db_drop_and_create_all seed them)
+    '''
+    @classmethod
+    def bump(cls, *names):
+        table = cls.__table__
+        bumps = db.session.info.setdefault('bumps', {})
+        for name in names:
+            bumps[name] = bumps.get(name, 0) + 1
+        bumped = db.session.execute(
+            table.update().where(table.c.name.in_(names)).values(
+                version=table.c.version + 1,
+                updated_at=datetime.utcnow())).rowcount
+        if bumped < len(set(names)):
+            raise RuntimeError(
+                'table_versions has no row for one of %s, '
+                'run the migrations' % ', '.join(sorted(set(names))))
+
+    '''
+    seed(*names): inserts the version rows of the tables, for a database
+    created without the migrations
+    '''
+    @classmethod
+    def seed(cls, *names):
+        now = datetime.utcnow()
+        db.session.execute(cls.__table__.insert(), [
+            {'name': name, 'version': 1, 'updated_at': now}
+            for name in names])
+
+    '''
+    current(*names): returns {name: (version, updated_at)} of the tables
+    current_statement and versions are its two halves for the async reads
+    '''
+    @classmethod
+    def current(cls, *names):
+        return cls.versions(db.session.execute(cls.current_statement(*names)))
+
+    @classmethod
+    def current_statement(cls, *names):
+        table = cls.__table__
+        return select(table.c.name, table.c.version, table.c.updated_at) \
+            .where(table.c.name.in_(names))
+
+    @staticmethod
+    def versions(rows):
+        return {name: (version, updated_at)
+                for name, version, updated_at in rows}
+
+
+replica_set = ReplicaSet(
+    REPLICA_URLS, engine_options,
+    lambda connection: TableVersion.versions(connection.execute(
+        TableVersion.current_statement('movies', 'actors', 'roles'))))
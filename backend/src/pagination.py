@@ -0,0 +1,90 @@
+import os
+import json
+import base64
+
+'''
+Keyset pagination
+    the list endpoints return pages ordered by id
+    the position is an opaque cursor holding the last id of the previous
+    page, the next page is read with WHERE id > :last_id ORDER BY id
+    LIMIT :limit so every page costs the same whatever its depth
+'''
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+
+
+def encode_cursor(last_id):
+    raw = json.dumps({'id': last_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+'''
+decode_cursor(cursor)
+    returns the last id stored in the cursor
+    raises a ValueError if the cursor is malformed
+'''
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        last_id = json.loads(raw)['id']
+    except Exception:
+        raise ValueError('invalid cursor')
+    # bool is a subclass of int: {"id": true} is not a cursor
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError('invalid cursor')
+    return last_id
+
+
+'''
+page_args(args)
+    @INPUTS
+        args: the query string of the request (request.args)
+    returns (limit, last_id) read from ?limit= and ?cursor=
+    the limit is capped to MAX_PAGE_SIZE
+    raises a ValueError if one of the parameters is malformed
+'''
+
+
+def page_args(args):
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('invalid limit')
+    cursor = args.get('cursor')
+    last_id = decode_cursor(cursor) if cursor else None
+    return min(limit, MAX_PAGE_SIZE), last_id
+
+
+'''
+paginate(query, column, limit, last_id)
+    returns (rows, next_cursor) for the page after last_id
+    one extra row is read to know if there is a next page, next_cursor
+    is None on the last page
+'''
+
+
+def paginate(query, column, limit, last_id=None):
+    rows = page_query(query, column, limit, last_id).all()
+    return split_page(rows, column, limit)
+
+
+'''
+page_query(query, column, limit, last_id) / split_page(rows, column, limit)
+    the two halves of paginate, page_query also takes a Core select (the
+    async reads execute it on their own session)
+'''
+
+
+def page_query(query, column, limit, last_id=None):
+    if last_id is not None:
+        query = query.filter(column > last_id)
+    return query.order_by(column).limit(limit + 1)
+
+
+def split_page(rows, column, limit):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], column.key))
@@ -0,0 +1,151 @@
+import os
+import hmac
+import json
+import time
+import random
+import cProfile
+import contextvars
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+On-demand profiling
+    a request runs under cProfile when
+        - it carries the header X-Profile: <PROFILE_SECRET>, or
+        - it is drawn with the probability PROFILE_SAMPLE_RATE (e.g. 0.001)
+    the profile is written to PROFILE_DIR as <id>.pstats (python -m pstats,
+    snakeviz, gprof2dot, flameprof...) with <id>.json beside it: the
+    route, path, status, duration and the SQL statements of the request
+    with their duration (without their parameters)
+    the id is returned in the X-Profile-Id header, only the last
+    PROFILE_MAX_FILES profiles are kept
+    without PROFILE_DIR, or with neither a secret nor a sample rate, no
+    hook and no event listener is installed: zero overhead
+    only the flask routes are profiled (the async reads of asgi.py are not)
+'''
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 100))
+PROFILE_HEADER = 'X-Profile'
+
+current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.statements = []
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+
+
+def record_statement_start(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current_profile.get() is not None:
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+
+def record_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    profile = current_profile.get()
+    starts = conn.info.get('profile_start')
+    if profile is None or not starts:
+        return
+    profile.statements.append({
+        'statement': statement,
+        'duration_ms': (time.perf_counter() - starts.pop()) * 1000
+        })
+
+
+'''
+init_profiling(app, directory, secret, sample_rate, max_files)
+    installs the hooks when profiling is enabled, returns whether it is
+'''
+
+
+def init_profiling(app, directory=PROFILE_DIR, secret=PROFILE_SECRET,
+                   sample_rate=PROFILE_SAMPLE_RATE,
+                   max_files=PROFILE_MAX_FILES):
+    if not directory or not (secret or sample_rate > 0):
+        return False
+    os.makedirs(directory, exist_ok=True)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          record_statement_start):
+        event.listen(Engine, 'before_cursor_execute', record_statement_start)
+        event.listen(Engine, 'after_cursor_execute', record_statement)
+
+    def wanted():
+        header = request.headers.get(PROFILE_HEADER)
+        if secret and header and hmac.compare_digest(
+                header.encode('utf-8'), secret.encode('utf-8')):
+            return True
+        return random.random() < sample_rate
+
+    @app.before_request
+    def start_profile():
+        if wanted():
+            profile = RequestProfile()
+            current_profile.set(profile)
+            profile.profiler.enable()
+
+    @app.after_request
+    def write_profile(response):
+        profile = current_profile.get()
+        if profile is None:
+            return response
+        profile.profiler.disable()
+        current_profile.set(None)
+        profile_id = write(directory, profile, response.status_code)
+        prune(directory, max_files)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def stop_profile(error):
+        # a request which failed without a response
+        profile = current_profile.get()
+        if profile is not None:
+            profile.profiler.disable()
+            current_profile.set(None)
+
+    return True
+
+
+def write(directory, profile, status):
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    profile_id = '%s-%s-%s-%06d' % (
+        time.strftime('%Y%m%dT%H%M%S', time.gmtime(profile.started_at)),
+        request.method,
+        rule.strip('/').replace('/', '_').replace('<', '').replace(
+            '>', '').replace(':', '-') or 'root',
+        random.randrange(1000000))
+    profile.profiler.dump_stats(os.path.join(directory,
+                                             profile_id + '.pstats'))
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as file:
+        json.dump({
+            'id': profile_id,
+            'method': request.method,
+            'route': rule,
+            'path': request.full_path,
+            'status': status,
+            'started_at': profile.started_at,
+            'duration_ms': (time.perf_counter() - profile.start) * 1000,
+            'sql': profile.statements
+            }, file, indent=2)
+    return profile_id
+
+
+def prune(directory, max_files):
+    profiles = sorted(name[:-len('.pstats')]
+                      for name in os.listdir(directory)
+                      if name.endswith('.pstats'))
+    for profile_id in profiles[:max(0, len(profiles) - max_files)]:
+        for extension in ('.pstats', '.json'):
+            try:
+                os.remove(os.path.join(directory, profile_id + extension))
+            except OSError:
+                pass
@@ -0,0 +1,305 @@
+import os
+from datetime import datetime, time
+from sqlalchemy import select
+
+from models import db, Movie, Actor, Role
+
+'''
+Read queries of the list and detail endpoints
+    ?fields=id,name selects only these columns
+    ?include=actors (movies) adds the related names with one extra query
+    for the whole page, without it the roles are not joined at all
+    ?ids=1,2,3 reads a batch of rows with one IN query in the order of
+    the ids
+    ?q= and the range parameters filter the rows in SQL, they combine
+    with the pagination, the export and ?ids=
+
+    without ?fields= nor ?include= the responses keep their historical
+    shape: the movies embed the names of their actors, the actors do not
+    embed anything
+'''
+
+MAX_BATCH_IDS = int(os.environ.get('MAX_BATCH_IDS', 100))
+
+
+class Resource:
+    def __init__(self, model, fields, include, legacy_include,
+                 related_statement, filters):
+        self.model = model
+        # api name -> column, 'id' is always selected (pagination)
+        self.fields = fields
+        self.include = include
+        self.legacy_include = legacy_include
+        self.related_statement = related_statement
+        # query parameter -> function building the SQL predicate
+        self.filters = filters
+
+    '''
+    parse(args)
+        returns (fields, include) read from ?fields= and ?include=
+        include is True if the related rows are requested
+        raises a ValueError for an unknown field or include
+    '''
+    def parse(self, args):
+        raw_fields = args.get('fields')
+        raw_include = args.get('include')
+        if raw_fields is None and raw_include is None:
+            return ['id', 'name'], self.legacy_include
+
+        fields = ['id', 'name']
+        if raw_fields is not None:
+            fields = [field for field in raw_fields.split(',') if field]
+            unknown = set(fields) - set(self.fields)
+            if unknown or not fields:
+                raise ValueError('unknown fields %s' % ', '.join(unknown))
+        include = False
+        if raw_include:
+            includes = set(raw_include.split(','))
+            if includes - {self.include}:
+                raise ValueError('unknown include %s' % raw_include)
+            include = True
+        return fields, include
+
+    def is_legacy(self, args):
+        return args.get('fields') is None and args.get('include') is None
+
+    '''
+    criteria(args)
+        returns the list of the SQL predicates of the search parameters
+        (?q=, ?release_from=, ?age_min=, ...), the empty ones are ignored
+        raises a ValueError if a value is malformed
+    '''
+    def criteria(self, args):
+        return [build(args[name]) for name, build in self.filters.items()
+                if args.get(name)]
+
+    '''
+    query(fields, criteria=()) / select(fields, criteria=())
+        ORM query (Core select for the async reads, asgi.py) of the
+        selected columns, labelled with their api names, of the rows
+        matching all the criteria
+    '''
+    def query(self, fields, criteria=()):
+        return db.session.query(*self._columns(fields)).filter(*criteria)
+
+    def select(self, fields, criteria=()):
+        return select(*self._columns(fields)).where(*criteria)
+
+    def _columns(self, fields):
+        return [self.fields['id'].label('id')] + [
+            self.fields[field].label(field)
+            for field in fields if field != 'id']
+
+    '''
+    related(ids)
+        returns {id: [(related id, related name), ...]} for a page of rows
+    '''
+    def related(self, ids):
+        return group_related(db.session.execute(self.related_statement(ids)))
+
+    '''
+    serialize(rows, fields, include, legacy, related=None)
+        returns the list of dicts of the rows
+        the related rows of all the rows are read with one query (unless
+        given as related), as names in the legacy shape and {id, name}
+        objects otherwise
+    '''
+    def serialize(self, rows, fields, include, legacy=False, related=None):
+        if related is None:
+            related = {}
+            if include and rows:
+                related = self.related([row.id for row in rows])
+        items = []
+        for row in rows:
+            mapping = row._mapping
+            item = {field: mapping[field] for field in fields}
+            if include:
+                linked = related.get(row.id, [])
+                item[self.include] = (
+                    [name for _, name in linked] if legacy else
+                    [{'id': id, 'name': name} for id, name in linked])
+            items.append(item)
+        return items
+
+    '''
+    parse_ids(args)
+        returns the list of the ids of ?ids=1,2,3 without duplicates, in
+        the order of the request, or None without ?ids=
+        raises a ValueError if an id is malformed or there are more than
+        MAX_BATCH_IDS
+    '''
+    def parse_ids(self, args):
+        raw = args.get('ids')
+        if raw is None:
+            return None
+        ids = list(dict.fromkeys(int(id) for id in raw.split(',') if id))
+        if not ids or len(ids) > MAX_BATCH_IDS:
+            raise ValueError('invalid ids')
+        return ids
+
+    '''
+    by_ids(ids, fields, include, legacy, criteria)
+        returns (items, missing) for a batch of ids
+            items: the serialized rows in the order of ids
+            missing: the ids which do not exist (or do not match the
+                criteria)
+        one IN query, the related rows are outer joined when included
+    '''
+    def by_ids(self, ids, fields, include, legacy=False, criteria=()):
+        found = self._load([self.fields['id'].in_(ids), *criteria],
+                           fields, include)
+        return self.order_by_ids(ids, found, include, legacy)
+
+    def order_by_ids(self, ids, found, include, legacy=False):
+        items = []
+        for id in ids:
+            if id not in found:
+                continue
+            item, related = found[id]
+            if include:
+                item[self.include] = (
+                    [name for _, name in related] if legacy else
+                    [{'id': related_id, 'name': name}
+                     for related_id, name in related])
+            items.append(item)
+        return items, [id for id in ids if id not in found]
+
+    '''
+    detail(id, fields, include)
+        returns (item, related) of one row or (None, None) if not found
+        related is the list of (id, name) of the related rows
+        one query: the related rows are outer joined when included
+    '''
+    def detail(self, id, fields, include):
+        return self._load([self.fields['id'] == id], fields, include).get(
+            id, (None, None))
+
+    '''
+    _load(criteria, fields, include)
+        returns {id: (item, related)} of the rows matching the criteria
+        load_statement and group_loaded are its two halves, the async
+        reads run the statement on their own session
+    '''
+    def _load(self, criteria, fields, include):
+        return self.group_loaded(db.session.execute(
+            self.load_statement(criteria, fields, include)), fields)
+
+    def load_statement(self, criteria, fields, include):
+        statement = self.select(fields, criteria)
+        if not include:
+            return statement
+
+        other = Actor if self.model is Movie else Movie
+        other_name = Actor.name if other is Actor else Movie.title
+        own_key = Role.movie_id if self.model is Movie else Role.actor_id
+        other_key = Role.actor_id if other is Actor else Role.movie_id
+        return statement.add_columns(
+            other.id.label('related_id'), other_name.label('related_name')
+            ).outerjoin(Role, own_key == self.fields['id']).outerjoin(
+            other, other.id == other_key).order_by(Role.id)
+
+    def group_loaded(self, rows, fields):
+        loaded = {}
+        for row in rows:
+            if row.id not in loaded:
+                loaded[row.id] = (
+                    {field: row._mapping[field] for field in fields}, [])
+            related_id = row._mapping.get('related_id')
+            if related_id is not None:
+                loaded[row.id][1].append(
+                    (related_id, row._mapping['related_name']))
+        return loaded
+
+
+'''
+contains(column) / at_least(column, parse) / at_most(column, parse) /
+equals(column)
+    return the builders of the predicates of the search parameters
+    contains is a case insensitive substring search: ILIKE '%q%' served by
+    the trigram indexes on PostgreSQL, LIKE (case insensitive for ASCII)
+    on SQLite
+'''
+
+
+def contains(column):
+    def build(value):
+        escaped = value.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        return column.ilike('%' + escaped + '%', escape='\\')
+    return build
+
+
+def at_least(column, parse):
+    return lambda value: column >= parse(value)
+
+
+def at_most(column, parse):
+    return lambda value: column <= parse(value)
+
+
+def equals(column):
+    return lambda value: column == value
+
+
+def parse_date(value):
+    # ValueError if the date is malformed
+    return datetime.fromisoformat(value)
+
+
+def parse_date_end(value):
+    # a date without time includes the whole day
+    parsed = datetime.fromisoformat(value)
+    if len(value) == 10:
+        parsed = datetime.combine(parsed.date(), time.max)
+    return parsed
+
+
+'''
+cast_of(movie_ids) / filmography_of(actor_ids)
+    return the statement of the (id, related id, related name) rows of a
+    page of movies (actors)
+group_related(rows)
+    returns {id: [(related id, related name), ...]}
+'''
+
+
+def cast_of(movie_ids):
+    return select(Role.movie_id, Actor.id, Actor.name) \
+        .join(Actor, Actor.id == Role.actor_id) \
+        .where(Role.movie_id.in_(movie_ids)).order_by(Role.id)
+
+
+def filmography_of(actor_ids):
+    return select(Role.actor_id, Movie.id, Movie.title) \
+        .join(Movie, Movie.id == Role.movie_id) \
+        .where(Role.actor_id.in_(actor_ids)).order_by(Role.id)
+
+
+def group_related(rows):
+    related = {}
+    for id, related_id, name in rows:
+        related.setdefault(id, []).append((related_id, name))
+    return related
+
+
+MOVIES = Resource(
+    Movie,
+    {'id': Movie.id, 'name': Movie.title, 'release': Movie.release},
+    include='actors', legacy_include=True,
+    related_statement=cast_of,
+    filters={
+        'q': contains(Movie.title),
+        'release_from': at_least(Movie.release, parse_date),
+        'release_to': at_most(Movie.release, parse_date_end)})
+
+ACTORS = Resource(
+    Actor,
+    {'id': Actor.id, 'name': Actor.name, 'age': Actor.age,
+     'gender': Actor.gender},
+    include='movies', legacy_include=False,
+    related_statement=filmography_of,
+    filters={
+        'q': contains(Actor.name),
+        'age_min': at_least(Actor.age, int),
+        'age_max': at_most(Actor.age, int),
+        'gender': equals(Actor.gender)})
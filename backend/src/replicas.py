@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+'''
+Read replicas
+    with DATABASE_REPLICA_URLS (comma separated urls) the GET requests
+    read from the replicas in turn (round robin), everything else uses
+    DATABASE_URL (the primary)
+    the session of a request is routed by models.RoutingSession:
+        - the first read of a GET request picks a replica and the whole
+          request reads from it (one consistent snapshot)
+        - a flush or an INSERT/UPDATE/DELETE moves the session to the
+          primary for the rest of the request (reads after writes)
+    the lag of every replica is checked at most every
+    REPLICA_CHECK_SECONDS by comparing its table_versions with those of
+    the primary: a replica more than REPLICA_MAX_LAG_SECONDS behind, or
+    failing, is skipped until the next check, without replica the reads
+    fall back to the primary
+    after a commit of this worker the reads stay on the primary during
+    REPLICA_MAX_LAG_SECONDS so a client reads its own writes
+    the other workers may still read a replica behind the commit: the
+    response cache keys its entries on the table_versions read in the
+    same request (@conditional, @versioned), so a body read from a
+    replica is only served to the requests seeing the same versions,
+    never to those reading the newer versions of the primary
+'''
+
+logger = logging.getLogger(__name__)
+
+REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://', 1)
+                for url in os.environ.get('DATABASE_REPLICA_URLS',
+                                          '').split(',')
+                if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 1))
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def reads_from_replica():
+    return has_request_context() and request.method in READ_METHODS
+
+
+'''
+replication_lag(primary, replica, now)
+    @INPUTS
+        primary, replica: {table: (version, updated_at)} of each database
+    returns the seconds since the last write applied by the replica to a
+    table where it is behind, 0 when it has every version of the primary
+    (an upper bound of its staleness)
+'''
+
+
+def replication_lag(primary, replica, now):
+    lag = 0.0
+    for name, (version, updated_at) in primary.items():
+        own = replica.get(name)
+        if own is None or own[0] < version:
+            since = own[1] if own is not None else updated_at
+            lag = max(lag, (now - since).total_seconds())
+    return lag
+
+
+'''
+detach_pool(engine)
+    gives the engine a new empty pool in a forked process without closing
+    the connections of the parent (Engine.dispose(close=False) needs
+    SQLAlchemy 1.4.33), the pool of the parent is kept referenced so the
+    garbage collector never closes its connections from the child
+'''
+
+inherited_pools = []
+
+
+def detach_pool(engine):
+    inherited_pools.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+
+class Replica:
+    def __init__(self, url, engine_options):
+        self.url = url
+        self.engine_options = engine_options
+        self._engine = None
+        self.lag = None
+        self.healthy = False
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = create_engine(self.url, **self.engine_options)
+        return self._engine
+
+    def dispose(self):
+        if self._engine is not None:
+            detach_pool(self._engine)
+
+
+class ReplicaSet:
+    '''
+    ReplicaSet(urls, engine_options, read_versions)
+        @INPUTS
+            engine_options: function returning the options of the engine
+                of a url (models.engine_options)
+            read_versions: function returning {table: (version,
+                updated_at)} read on a connection
+    '''
+    def __init__(self, urls, engine_options, read_versions,
+                 max_lag=REPLICA_MAX_LAG_SECONDS,
+                 check_seconds=REPLICA_CHECK_SECONDS):
+        self.replicas = [Replica(url, engine_options(url)) for url in urls]
+        self.read_versions = read_versions
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self.checked_at = None
+        self.written_at = None
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.check_lock = threading.Lock()
+
+    '''
+    choose(primary)
+        returns the engine of the next available replica, or None to read
+        from the primary engine
+    '''
+    def choose(self, primary):
+        if not self.replicas:
+            return None
+        now = time.monotonic()
+        if (self.written_at is not None and
+                now - self.written_at < self.max_lag):
+            return None
+        if self.checked_at is None or now - self.checked_at >= \
+                self.check_seconds:
+            self.check(primary)
+        available = [replica for replica in self.replicas
+                     if replica.healthy and replica.lag <= self.max_lag]
+        if not available:
+            return None
+        with self.lock:
+            self.turn += 1
+            return available[self.turn % len(available)].engine
+
+    '''
+    check(primary)
+        measures the lag of the replicas, one thread checks while the
+        others keep the previous measure
+    '''
+    def check(self, primary):
+        if not self.check_lock.acquire(blocking=False):
+            return
+        try:
+            now = datetime.utcnow()
+            try:
+                with primary.connect() as connection:
+                    versions = self.read_versions(connection)
+            except Exception:
+                logger.exception('replica check: primary')
+                versions = None
+            for replica in self.replicas:
+                if versions is None:
+                    replica.healthy = False
+                    continue
+                try:
+                    with replica.engine.connect() as connection:
+                        replica.lag = replication_lag(
+                            versions, self.read_versions(connection), now)
+                    replica.healthy = True
+                except Exception:
+                    logger.warning('replica check: %s unavailable',
+                                   replica.engine.url)
+                    replica.healthy = False
+                if replica.healthy and replica.lag > self.max_lag:
+                    logger.info('replica %s behind by %.1fs',
+                                replica.engine.url, replica.lag)
+            self.checked_at = time.monotonic()
+        finally:
+            self.check_lock.release()
+
+    '''
+    record_write(): called after a commit of this worker
+    '''
+    def record_write(self):
+        self.written_at = time.monotonic()
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.dispose()
+
+    def stats(self):
+        return [{'url': make_url(replica.url).render_as_string(
+                    hide_password=True),
+                 'healthy': replica.healthy,
+                 'lag': replica.lag} for replica in self.replicas]
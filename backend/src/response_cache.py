@@ -0,0 +1,244 @@
+import os
+import time
+import logging
+from functools import wraps
+from flask import request, g, make_response
+
+from cache import TTLCache
+from export import wants_ndjson
+from singleflight import SingleFlight
+
+'''
+Response cache
+    read-through cache of the json bodies of the GET routes
+    an entry is stored with tags naming what it depends on:
+        'movies' / 'actors': the list pages
+        'movie:<id>' / 'actor:<id>': a movie (actor) shown in the entry
+    the writes record the tags they change (models.invalidate) and the
+    entries carrying one of them are deleted after the commit
+
+    backends:
+        LocalBackend: in-process LRU with a time to live (default), every
+            gunicorn worker has its own, an entry written by another
+            worker lives at most RESPONSE_CACHE_TTL seconds
+        SharedBackend: a redis-like server shared by the workers, used
+            when RESPONSE_CACHE_URL is set (needs the redis package),
+            any client with get/set/delete/sadd/smembers/expire works
+
+    the routes add the versions of their tables (@conditional,
+    @versioned) to the key: an entry computed before a write, kept by
+    another worker or stored after the invalidation, is never read again
+
+    stampedes: the misses of identical requests (same path, query string
+    and permissions) running at the same time are computed once per
+    worker (singleflight.py), and a local entry expiring in less than
+    RESPONSE_CACHE_REFRESH_AHEAD seconds is recomputed by one request
+    while the others are still served the cached body
+'''
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+RESPONSE_CACHE_REFRESH_AHEAD = float(
+    os.environ.get('RESPONSE_CACHE_REFRESH_AHEAD', 2))
+
+
+class LocalBackend(TTLCache):
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._tags = {}
+
+    def set(self, key, value, tags=(), ttl=None):
+        with self._lock:
+            self.delete(key)
+            super().set(key, (value, tuple(tags)), ttl=ttl)
+            if key in self._data:
+                for tag in tags:
+                    self._tags.setdefault(tag, set()).add(key)
+
+    def get(self, key):
+        entry = super().get(key)
+        return None if entry is None else entry[0]
+
+    '''
+    lookup(key): returns (value, seconds before its expiry)
+    '''
+    def lookup(self, key):
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                return None, None
+            return value, self._data[key][1] - time.monotonic()
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self.delete(key)
+
+    def _removed(self, key, value):
+        for tag in value[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SharedBackend:
+    def __init__(self, client, ttl, prefix='capstone:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def lookup(self, key):
+        return self.get(key), None
+
+    def set(self, key, value, tags=(), ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, value, ex=ttl)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            self.client.sadd(tag_key, self.prefix + key)
+            self.client.expire(tag_key, ttl)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = list(self.client.smembers(tag_key))
+            self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+def create_backend():
+    if RESPONSE_CACHE_URL:
+        import redis
+        return SharedBackend(redis.Redis.from_url(RESPONSE_CACHE_URL),
+                             RESPONSE_CACHE_TTL)
+    return LocalBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        # incremented by every invalidation of this process, a response
+        # computed while one happened may be stale and is not stored (the
+        # writes of the other workers change the versions of the key)
+        self.generation = 0
+        self.flights = SingleFlight()
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    '''
+    lookup(key)
+        returns (value, expiring): expiring is True for a local entry
+        expiring in less than RESPONSE_CACHE_REFRESH_AHEAD seconds, the
+        caller recomputes it unless another request already does
+    '''
+    def lookup(self, key):
+        value, ttl = self.backend.lookup(key)
+        return value, (value is not None and ttl is not None and
+                       ttl < RESPONSE_CACHE_REFRESH_AHEAD)
+
+    def set(self, key, value, tags=()):
+        self.backend.set(key, value, tags)
+
+    '''
+    invalidate(tags): deletes the entries carrying one of the tags
+    a broken shared backend must not fail the write that triggered it
+    '''
+    def invalidate(self, tags):
+        self.generation += 1
+        try:
+            self.backend.invalidate(tags)
+        except Exception:
+            logger.exception('response cache invalidation')
+
+    def stats(self):
+        return self.backend.stats()
+
+
+response_cache = ResponseCache(create_backend())
+
+
+'''
+@cached(*tags)
+    caches the 200 json responses of a GET route by path and query string
+    and the versions of g.versions_stamp
+    the tags are formatted with the arguments of the route, e.g.
+    @cached('movie:{movie_id}'), the route can add tags that depend on its
+    content to g.cache_tags
+    the concurrent misses of a key with the same permissions (the payload
+    given by @requires_auth) wait for the first one and share its body
+    the streamed exports (Accept: application/x-ndjson) are not cached
+'''
+
+
+def cached(*tags):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if wants_ndjson(request):
+                # not cached, the route may still record its tags
+                g.cache_tags = set()
+                return f(*args, **kwargs)
+            key = request.full_path
+            if 'versions_stamp' in g:
+                # behind @conditional: one entry per data version
+                key += '#' + g.versions_stamp
+            payload = args[0] if args and isinstance(args[0], dict) else {}
+            flight = (key, tuple(sorted(payload.get('permissions', []))))
+            body, expiring = response_cache.lookup(key)
+            if body is not None and not (
+                    expiring and not response_cache.flights.running(flight)):
+                return json_response(body)
+
+            def compute():
+                g.cache_tags = {tag.format(**kwargs) for tag in tags}
+                generation = response_cache.generation
+                response = make_response(f(*args, **kwargs))
+                if (response.status_code == 200 and
+                        generation == response_cache.generation):
+                    response_cache.set(key, response.get_data(),
+                                       g.cache_tags)
+                return response
+
+            response, shared = response_cache.flights.do(flight, compute)
+            if not shared:
+                return response
+            if response.status_code != 200:
+                return compute()
+            return json_response(response.get_data())
+        return wrapper
+    return cached_decorator
+
+
+def json_response(body):
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    return response
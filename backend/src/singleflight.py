@@ -0,0 +1,123 @@
+import os
+import asyncio
+import threading
+
+'''
+Single flight
+    coalesces the identical computations running at the same time: the
+    first caller of a key (the leader) runs it, the callers arriving
+    while it runs wait for its result instead of running the same
+    queries again
+    used by the response cache (@cached: a popular page which expires or
+    is invalidated is computed once per worker, not once per client) and
+    the statistics of GET /stats
+    a caller waiting longer than SINGLEFLIGHT_TIMEOUT seconds, or whose
+    leader failed, runs the computation itself
+'''
+
+SINGLEFLIGHT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT', 10))
+
+_FAILED = object()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = _FAILED
+        self.waiting = 0
+
+
+class SingleFlight:
+    def __init__(self, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    '''
+    do(key, fn)
+        returns (result, shared): the result of fn() and whether it was
+        computed by another caller
+    '''
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                call.waiting += 1
+        if not leader:
+            if call.done.wait(self.timeout) and call.result is not _FAILED:
+                self.shared += 1
+                return call.result, True
+            return fn(), False
+        try:
+            call.result = fn()
+            return call.result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def running(self, key):
+        return key in self.calls
+
+    def stats(self):
+        with self.lock:
+            return {'leaders': self.leaders, 'shared': self.shared,
+                    'running': len(self.calls),
+                    'waiting': sum(call.waiting
+                                   for call in self.calls.values())}
+
+
+'''
+AsyncSingleFlight
+    the same for the coroutines of the async mode (asgi.py), the waiting
+    requests are futures of the event loop
+'''
+
+
+class AsyncSingleFlight:
+    def __init__(self, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        call = self.calls.get(key)
+        if call is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(call),
+                                                self.timeout)
+            except asyncio.CancelledError:
+                # the leader was cancelled, not this request
+                if not call.cancelled():
+                    raise
+            except Exception:
+                pass
+            else:
+                self.shared += 1
+                return result, True
+            return await fn(), False
+        call = self.calls[key] = asyncio.get_running_loop().create_future()
+        self.leaders += 1
+        try:
+            result = await fn()
+            call.set_result(result)
+            return result, False
+        except Exception as e:
+            call.set_exception(e)
+            # retrieved by the waiting requests, not by the event loop
+            call.exception()
+            raise
+        finally:
+            if not call.done():
+                call.cancel()
+            del self.calls[key]
+
+    def running(self, key):
+        return key in self.calls
@@ -0,0 +1,105 @@
+import os
+from sqlalchemy import select, func, extract, desc
+
+from models import db, Movie, Actor, Role, TableVersion
+from cache import TTLCache
+from singleflight import SingleFlight
+
+'''
+Catalog statistics
+    used by GET /stats
+    every figure is one GROUP BY query returning a few rows, no ORM object
+    is loaded
+    the result is cached in process keyed on the versions of the movies,
+    actors and roles tables (TableVersion): a refresh of a dashboard costs
+    one primary key lookup until the catalog changes, and a write of any
+    worker moves the key so a stale result is never served
+    the requests arriving while a version is computed wait for it
+    (SingleFlight) instead of running the queries again
+'''
+
+STATS_TOP_ACTORS = int(os.environ.get('STATS_TOP_ACTORS', 10))
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 3600))
+
+TABLES = ('movies', 'actors', 'roles')
+
+stats_cache = TTLCache(maxsize=8, ttl=STATS_CACHE_TTL)
+stats_flights = SingleFlight()
+
+
+'''
+catalog_stats()
+    returns (stats, versions) where versions is {table: version} of the
+    data the stats were computed from
+'''
+
+
+def catalog_stats():
+    current = TableVersion.current(*TABLES)
+    versions = {name: current[name][0] if name in current else 0
+                for name in TABLES}
+    key = tuple(versions[name] for name in TABLES)
+    stats = stats_cache.get(key)
+    if stats is None:
+        stats, shared = stats_flights.do(key, compute_stats)
+        if not shared:
+            stats_cache.set(key, stats)
+    return stats, versions
+
+
+def compute_stats():
+    execute = db.session.execute
+
+    year = extract('year', Movie.release)
+    movies_per_year = execute(
+        select(year, func.count(Movie.id)).where(Movie.release.isnot(None))
+        .group_by(year).order_by(year)).all()
+
+    cast = select(Movie.id, func.count(Role.id).label('size')) \
+        .outerjoin(Role, Role.movie_id == Movie.id) \
+        .group_by(Movie.id).subquery()
+    cast_sizes = execute(
+        select(cast.c.size, func.count()).group_by(cast.c.size)
+        .order_by(cast.c.size)).all()
+
+    by_gender = execute(
+        select(Actor.gender, func.count(Actor.id)).group_by(Actor.gender)
+        .order_by(Actor.gender)).all()
+
+    decade = (Actor.age / 10) * 10
+    by_age = execute(
+        select(decade, func.count(Actor.id)).where(Actor.age.isnot(None))
+        .group_by(decade).order_by(decade)).all()
+
+    top_actors = execute(
+        select(Actor.id, Actor.name, func.count(Role.id).label('movies'))
+        .join(Role, Role.actor_id == Actor.id)
+        .group_by(Actor.id, Actor.name)
+        .order_by(desc('movies'), Actor.id)
+        .limit(STATS_TOP_ACTORS)).all()
+
+    movies, actors, roles, average_age = execute(select(
+        select(func.count(Movie.id)).scalar_subquery(),
+        select(func.count(Actor.id)).scalar_subquery(),
+        select(func.count(Role.id)).scalar_subquery(),
+        select(func.avg(Actor.age)).scalar_subquery())).one()
+
+    return {
+        'totals': {
+            'movies': movies,
+            'actors': actors,
+            'roles': roles,
+            'average_age': (float(average_age)
+                            if average_age is not None else None)
+            },
+        'movies_per_year': [{'year': int(year), 'movies': count}
+                            for year, count in movies_per_year],
+        'cast_sizes': [{'cast_size': size, 'movies': count}
+                       for size, count in cast_sizes],
+        'actors_by_gender': [{'gender': gender, 'actors': count}
+                             for gender, count in by_gender],
+        'actors_by_age': [{'age_from': int(age), 'actors': count}
+                          for age, count in by_age],
+        'top_actors': [{'id': id, 'name': name, 'movies': count}
+                       for id, name, count in top_actors]
+        }
@@ -1,14 +1,40 @@
 
 import os
+import sys
 import unittest
+import importlib.util
 import json
+import base64
+import tempfile
+import asyncio
+import pstats
+import threading
+from datetime import date, datetime, timedelta, timezone
+from unittest import mock
 from sqlalchemy.sql.expression import true
 
+from sqlalchemy import event, create_engine
+from sqlalchemy.pool import QueuePool
 from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 from app import create_app
-from models import setup_db, db_drop_and_create_all
+from models import (setup_db, db_drop_and_create_all, db, engine_options,
+                    replica_set, TableVersion,
+                    Movie, Actor, Role)
+from jwks import JWKSStore
+from auth import token_cache
+from response_cache import SharedBackend, LocalBackend, response_cache
+from graph import CoStarGraph, build_csr, costar_graph
+from stats import stats_cache
+from asgi import AsyncAPI, async_database_url
+from conditional import last_modified_of, not_modified
+from json_provider import create_provider, jsonify
+from replicas import ReplicaSet, Replica, replication_lag
+from singleflight import SingleFlight, AsyncSingleFlight
+from profiling import init_profiling
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -119,6 +145,370 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)   
 
+    # Number of queries of GET /movies must not grow with the rows
+    def count_queries(self, path, token):
+        return len(self.capture_queries(path, token))
+
+    def capture_queries(self, path, token):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get(path, headers={
+                "Authorization": 'bearer ' + token})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return statements
+
+    def add_movies_with_cast(self, count):
+        with self.app.app_context():
+            for i in range(count):
+                movie = Movie(title='movie unit %d' % i)
+                movie.insert()
+                actor = Actor(name='actor unit %d' % i)
+                actor.insert()
+                Role(movie_id=movie.id, actor_id=actor.id).insert()
+
+    def test_get_movies_query_count_is_flat(self):
+        self.add_movies_with_cast(2)
+        few = self.count_queries('/movies', self.token_assistant)
+        self.add_movies_with_cast(20)
+        many = self.count_queries('/movies', self.token_assistant)
+        self.assertEqual(few, many)
+
+    # Keyset pagination of GET /movies
+    def test_200_get_movies_pages_with_token_assistant(self):
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        res = self.client().get('/movies?limit=2', headers=headers)
+        first = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(first['movies']), 2)
+        self.assertTrue(first['next_cursor'])
+        res = self.client().get(
+            '/movies?limit=2&cursor=' + first['next_cursor'], headers=headers)
+        second = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(second['movies'][0]['id'] >
+                        first['movies'][-1]['id'])
+
+    def test_400_get_actors_bad_cursor_with_token_assistant(self):
+        res = self.client().get('/actors?cursor=unit', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_movies_bool_cursor_with_token_assistant(self):
+        for value in (b'{"id": true}', b'{"id": false}'):
+            cursor = base64.urlsafe_b64encode(value).decode('ascii')
+            res = self.client().get('/movies?cursor=' + cursor, headers={
+                "Authorization": 'bearer ' + self.token_assistant})
+            self.assertEqual(res.status_code, 400)
+
+    # Sparse fieldsets and includes
+    def test_200_get_actors_fields_with_token_assistant(self):
+        res = self.client().get('/actors?fields=id,age', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'age'})
+
+    def test_200_get_movies_include_actors_with_token_assistant(self):
+        res = self.client().get('/movies?fields=id&include=actors', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'id', 'actors'})
+
+    def test_get_movies_without_include_does_not_join_roles(self):
+        self.add_movies_with_cast(2)
+        statements = self.capture_queries('/movies?fields=id,name',
+                                          self.token_assistant)
+        self.assertFalse([statement for statement in statements
+                          if ' roles' in statement])
+
+    def test_400_get_movies_unknown_field_with_token_assistant(self):
+        res = self.client().get('/movies?fields=budget', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Search and filters
+    def test_200_search_movies_with_token_assistant(self):
+        self.add_movies_with_cast(3)
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        res = self.client().get('/movies?q=UNIT%201&limit=1', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['name'] for movie in data['movies']],
+                         ['movie unit 1'])
+
+    def test_200_filter_actors_by_age_with_token_assistant(self):
+        res = self.client().get('/actors?age_min=40&age_max=60', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            expected = Actor.query.filter(Actor.age.between(40, 60)).count()
+        self.assertEqual(len(data['actors']), min(expected, 50))
+
+    def test_400_filter_movies_bad_date_with_token_assistant(self):
+        res = self.client().get('/movies?release_from=yesterday', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    # Batch fetch by ids
+    def test_200_get_actors_by_ids_with_token_assistant(self):
+        res = self.client().get('/actors?ids=2,1,100000', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [2, 1])
+        self.assertEqual(data['missing'], [100000])
+
+    def test_get_movies_by_ids_is_one_query(self):
+        self.add_movies_with_cast(3)
+        statements = self.capture_queries('/movies?ids=3,2,1&include=actors',
+                                          self.token_assistant)
+        self.assertEqual(len([statement for statement in statements
+                              if ' roles' in statement]), 1)
+
+    def test_400_get_movies_bad_ids_with_token_assistant(self):
+        res = self.client().get('/movies?ids=1,a', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 400)
+
+    # Conditional GET /movies
+    def test_304_get_movies_not_modified_with_token_assistant(self):
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        res = self.client().get('/movies', headers=headers)
+        etag = res.headers['ETag']
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_200_get_movies_modified_with_token_producer(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        etag = self.client().get('/movies', headers=headers).headers['ETag']
+        self.client().patch('/actors/1', json={"name": "John Etag"},
+                            headers=headers)
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Response cache of GET /movies/<id>
+    def test_200_get_movie_cache_invalidated_with_token_producer(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        res = self.client().get('/movies/1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.client().patch('/actors/1', json={"name": "John Cache"},
+                            headers=headers)
+        res = self.client().get('/movies/1', headers=headers)
+        data = json.loads(res.data)
+        self.assertTrue('John Cache' in
+                        [actor['name'] for actor in data['actors']])
+
+    # A write of another worker (versions bumped, local cache untouched)
+    def test_200_get_actors_cache_keyed_on_versions(self):
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        res = self.client().get('/actors?ids=1', headers=headers)
+        etag = res.headers['ETag']
+        with self.app.app_context():
+            table = Actor.__table__
+            db.session.execute(table.update().where(table.c.id == 1).values(
+                name='Other Worker'))
+            TableVersion.bump('actors')
+            db.session.commit()
+        res = self.client().get('/actors?ids=1', headers=headers)
+        data = json.loads(res.data)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(data['actors'][0]['name'], 'Other Worker')
+
+    # The caches of two workers: a write through one, reads through the
+    # other
+    def test_200_get_movie_fresh_on_other_worker(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        worker_b = response_cache.backend
+        self.client().get('/movies/1', headers=headers)
+        response_cache.backend = LocalBackend(10, 30)
+        try:
+            res = self.client().patch('/movies/1', json={"title": "worker a"},
+                                      headers=headers)
+            self.assertEqual(res.status_code, 200)
+        finally:
+            response_cache.backend = worker_b
+        res = self.client().get('/movies/1', headers=headers)
+        self.assertEqual(json.loads(res.data)['movies'], "worker a")
+
+    def test_200_get_movie_fresh_after_late_shared_set(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        local = response_cache.backend
+        shared = response_cache.backend = SharedBackend(LocalRedis(), ttl=30)
+        try:
+            self.client().get('/movies/1', headers=headers)
+            before_write = dict(shared.client.values)
+            self.client().patch('/movies/1', json={"title": "worker a"},
+                                headers=headers)
+            # a worker which read before the commit stores its body after
+            # the invalidation
+            shared.client.values.update(before_write)
+            res = self.client().get('/movies/1', headers=headers)
+            self.assertEqual(json.loads(res.data)['movies'], "worker a")
+        finally:
+            response_cache.backend = local
+
+    # Streaming export of GET /actors
+    def test_200_export_actors_with_token_assistant(self):
+        res = self.client().get('/actors', headers={
+            "Authorization": 'bearer ' + self.token_assistant,
+            "Accept": 'application/x-ndjson'})
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(lines))
+        self.assertTrue('name' in json.loads(lines[0]))
+
+    # Catalog statistics
+    def test_200_get_stats_with_token_assistant(self):
+        res = self.client().get('/stats', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(data['stats']['totals']['movies'],
+                             Movie.query.count())
+        self.assertEqual(sum(size['movies'] for size in
+                             data['stats']['cast_sizes']),
+                         data['stats']['totals']['movies'])
+
+    def test_get_stats_cached_until_write(self):
+        stats_cache.clear()
+        self.assertTrue(self.count_queries('/stats', self.token_assistant)
+                        > 3)
+        cached = self.count_queries('/stats', self.token_assistant)
+        self.assertTrue(cached <= 3)
+        with self.app.app_context():
+            Movie(title='Stats unit').insert()
+        self.assertTrue(
+            self.count_queries('/stats', self.token_assistant) > cached)
+
+    # Co-star graph
+    def test_200_get_costars_patched_with_token_producer(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        res = self.client().get('/actors/1/costars', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        builds = costar_graph.builds
+        with self.app.app_context():
+            movie = Movie(title='Graph unit')
+            movie.insert()
+            movie_id = movie.id
+            actor = Actor(name='Graph actor', age=30, gender='F')
+            actor.insert()
+            actor_id = actor.id
+        self.client().post('/roles', json=[
+            {"movie_id": movie_id, "actor_id": 1},
+            {"movie_id": movie_id, "actor_id": actor_id}], headers=headers)
+        res = self.client().get('/actors/1/costars?limit=100',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertTrue(actor_id in [a['id'] for a in data['actors']])
+        self.assertEqual(costar_graph.builds, builds)
+        res = self.client().get('/actors/%d/path/1' % actor_id,
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['degrees'], 1)
+
+    def test_404_get_path_not_connected_with_token_assistant(self):
+        res = self.client().get('/actors/1/path/100000', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 404)
+
+    def test_costar_graph_built_outside_its_lock(self):
+        costar_graph.version = None
+        locked = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if 'FROM roles' in statement:
+                locked.append(costar_graph.lock.locked())
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get('/actors/1/costars', headers={
+                "Authorization": 'bearer ' + self.token_assistant})
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(locked)
+        self.assertFalse(any(locked))
+
+    def test_404_get_costars_unknown_actor_with_token_assistant(self):
+        res = self.client().get('/actors/100000/costars', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        res = self.client().get('/actors/100000/path/100000', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 404)
+
+    # Batch of operations
+    def test_200_batch_with_token_producer(self):
+        res = self.client().post('/batch', json=[
+            {"method": "POST", "path": "/actors",
+             "body": {"name": "Batch Actor", "age": 30, "gender": "F"}},
+            {"method": "PATCH", "path": "/actors/1", "body": {"age": 51}}
+            ], headers={"Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result in data['results']],
+                         [200, 200])
+
+    def test_422_batch_rolled_back_with_token_producer(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        res = self.client().post('/batch', json=[
+            {"method": "POST", "path": "/actors",
+             "body": {"name": "Batch Rollback", "age": 30, "gender": "F"}},
+            {"method": "DELETE", "path": "/actors/100000"}
+            ], headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['failed'], 1)
+        with self.app.app_context():
+            self.assertIsNone(
+                Actor.query.filter_by(name='Batch Rollback').first())
+
+    def test_200_batch_not_atomic_with_token_producer(self):
+        res = self.client().post('/batch?atomic=false', json=[
+            {"method": "DELETE", "path": "/actors/100000"},
+            {"method": "PATCH", "path": "/actors/1", "body": {"age": 52}}
+            ], headers={"Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result in data['results']],
+                         [404, 200])
+
+    def test_422_batch_permission_with_token_assistant(self):
+        res = self.client().post('/batch', json=[
+            {"method": "DELETE", "path": "/movies/1"}
+            ], headers={"Authorization": 'bearer ' + self.token_assistant})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'][0]['status'], 403)
+
     # ENDPOINTS Delete /actors/1 and /movies/1
     def test_200_delete_actors_with_token_producer(self):
         res = self.client().delete('/actors/1', headers={
@@ -152,6 +542,23 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'],False)
         self.assertEqual(data['message'],'resource not found')
 
+    def test_404_delete_unknown_movie_with_token_producer(self):
+        res = self.client().delete('/movies/100000', headers={
+            "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_404_patch_unknown_actor_with_token_producer(self):
+        res = self.client().patch(
+            '/actors/100000',
+            json={"name": "John Unit"},
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     # ENDPOINTS POST /actors and /movies    
     def test_200_post_actors_with_token_producer(self):
         res = self.client().post('/actors',json=self.new_actor,headers={
@@ -160,6 +567,28 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(data['actors']))
         self.assertEqual(data['success'],True)
+
+    def test_roles_version_kept_without_cast_change(self):
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        with self.app.app_context():
+            roles = TableVersion.current('roles')['roles'][0]
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=headers)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        self.client().patch('/actors/%d' % actor_id,
+                            json={"name": "actor no cast"}, headers=headers)
+        res = self.client().delete('/actors/%d' % actor_id, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(TableVersion.current('roles')['roles'][0], roles)
+
+    # a missing version row is a setup error, bump never inserts it
+    def test_bump_without_version_row_raises(self):
+        with self.app.app_context():
+            with self.assertRaises(RuntimeError):
+                TableVersion.bump('movies', 'unknown')
+            db.session.rollback()
+            self.assertEqual(TableVersion.current('unknown'), {})
     
     def test_200_post_movies_with_token_producer(self):
         res = self.client().post(
@@ -196,6 +625,98 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'],'unprocessable') 
 
+    # ENDPOINTS POST /actors/bulk and /movies/bulk
+    def test_200_post_actors_bulk_with_token_producer(self):
+        res = self.client().post(
+            '/actors/bulk',
+            json=[self.new_actor, {"name": "actor bulk", "age": 30,
+                                   "gender": "unit"}],
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertEqual(data['errors'], [])
+
+    def test_422_post_movies_bulk_with_token_producer(self):
+        res = self.client().post(
+            '/movies/bulk',
+            json=[self.new_movie, {"tit": "new"}],
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    def test_422_post_movies_bulk_bad_types_with_token_producer(self):
+        res = self.client().post(
+            '/movies/bulk',
+            json=[self.new_movie, {"title": 5, "release": "2011-11-11"},
+                  {"title": "movie bulk", "release": "soon"},
+                  {"title": "movie bulk", "release": 2011}],
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([error['index'] for error in data['errors']],
+                         [1, 2, 3])
+
+    def test_200_post_actors_bulk_partial_with_token_producer(self):
+        res = self.client().post(
+            '/actors/bulk?partial=true',
+            json={"actors": [self.new_actor, {"name": "no age"}]},
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    # ENDPOINTS POST and DELETE /roles
+    def test_200_post_roles_with_token_producer(self):
+        res = self.client().post(
+            '/roles',
+            json=[{"movie_id": 3, "actor_id": 1},
+                  {"movie_id": 3, "actor_id": 2},
+                  {"movie_id": 1, "actor_id": 1}],
+            headers={
+                "Authorization": 'bearer ' + self.token_producer})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+
+    def test_200_delete_roles_with_token_director(self):
+        res = self.client().delete(
+            '/roles',
+            json={"roles": [{"movie_id": 1, "actor_id": 1},
+                            {"movie_id": 1, "actor_id": 3}]},
+            headers={
+                "Authorization": 'bearer ' + self.token_director})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 1)
+
+    def test_422_post_roles_not_integer_ids_with_token_producer(self):
+        for bad in (True, 1.5, "7", None):
+            res = self.client().post(
+                '/roles',
+                json=[{"movie_id": 3, "actor_id": 1},
+                      {"movie_id": bad, "actor_id": 2}],
+                headers={
+                    "Authorization": 'bearer ' + self.token_producer})
+            self.assertEqual(res.status_code, 422, bad)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.get(3).actors, [])
+
+    def test_403_post_roles_with_token_assistant(self):
+        res = self.client().post(
+            '/roles',
+            json=[{"movie_id": 3, "actor_id": 1}],
+            headers={
+                "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 403)
+
     # ENDPOINTS PATCH /actors and /movies 
     def test_200_patch_actors_with_token_producer(self):
         res = self.client().patch(
@@ -250,6 +771,64 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data['success'], False)
 
+    # Tokens altered after their signature
+    def forge(self, header=None, payload=None, signature=None):
+        def decode(part):
+            return json.loads(base64.urlsafe_b64decode(
+                part + '=' * (-len(part) % 4)))
+
+        def encode(part):
+            return base64.urlsafe_b64encode(
+                json.dumps(part).encode('utf-8')).decode('ascii').rstrip('=')
+
+        parts = self.token_assistant.split('.')
+        if header is not None:
+            parts[0] = encode(dict(decode(parts[0]), **header))
+        if payload is not None:
+            parts[1] = encode(dict(decode(parts[1]), **payload))
+        if signature is not None:
+            parts[2] = signature
+        return '.'.join(parts)
+
+    # a bad signature or algorithm (was 400) and an unknown key (was 403)
+    # are refused with 401 like any other invalid token
+    def assert_token_refused(self, token,
+                             message='Token signature is invalid.'):
+        res = self.client().get('/movies', headers={
+            "Authorization": 'bearer ' + token})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['error'], 401)
+        self.assertEqual(data['message'], message)
+
+    def test_401_tampered_payload(self):
+        self.assert_token_refused(self.forge(payload={
+            "permissions": ["get:movies", "delete:movies"]}))
+
+    def test_401_forged_signature(self):
+        signature = base64.urlsafe_b64encode(os.urandom(256))
+        self.assert_token_refused(self.forge(
+            signature=signature.decode('ascii').rstrip('=')))
+
+    def test_401_refused_algorithm(self):
+        self.assert_token_refused(self.forge(header={"alg": "none"},
+                                             signature=''))
+        self.assert_token_refused(self.forge(header={"alg": ""}))
+        self.assert_token_refused(self.forge(header={"alg": "RS"}))
+
+    def test_401_unknown_kid(self):
+        self.assert_token_refused(self.forge(header={"kid": "unknown"}),
+                                  'Unable to find the appropriate key.')
+
+    # Test the verified token cache
+    def test_token_cache_hit_with_token_assistant(self):
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        self.client().get('/movies', headers=headers)
+        hits = token_cache.hits
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(token_cache.hits, hits + 1)
 
     # Test Delete by Assistant
     def test_403_delete_movies_with_token_assistant(self):
@@ -278,5 +857,522 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['success'],False)
 
+    # GET requests read from a replica, writes stay on the primary
+    def test_get_movies_from_replica(self):
+        directory = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(directory, "replica.db")
+        replica = create_engine(url)
+        db.metadata.create_all(replica)
+        with self.app.app_context():
+            versions = TableVersion.current("movies", "actors", "roles")
+        with replica.begin() as connection:
+            connection.execute(TableVersion.__table__.insert(), [
+                {"name": name, "version": version, "updated_at": updated_at}
+                for name, (version, updated_at) in versions.items()])
+            connection.execute(Movie.__table__.insert(),
+                               {"id": 100, "title": "replica only"})
+        replica_set.replicas = [Replica(url, {})]
+        replica_set.written_at = None
+        replica_set.checked_at = None
+        try:
+            res = self.client().get('/movies?q=replica', headers={
+                "Authorization": 'bearer ' + self.token_assistant})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([movie['id'] for movie in data['movies']], [100])
+            self.assertEqual(replica_set.stats()[0]['lag'], 0)
+
+            res = self.client().patch('/movies/1', json={"title": "moved"},
+                                      headers={"Authorization": 'bearer ' +
+                                               self.token_producer})
+            self.assertEqual(res.status_code, 200)
+            # the worker reads its own write from the primary
+            res = self.client().get('/movies/1', headers={
+                "Authorization": 'bearer ' + self.token_assistant})
+            self.assertEqual(json.loads(res.data)['movies'], "moved")
+        finally:
+            replica_set.replicas = []
+            replica.dispose()
+
+    # a worker reading a replica behind the primary shares its cache with
+    # a worker reading the primary
+    def test_get_movie_from_lagging_replica_not_served_from_primary(self):
+        directory = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(directory, "replica.db")
+        replica = create_engine(url)
+        db.metadata.create_all(replica)
+        with self.app.app_context():
+            versions = TableVersion.current("movies", "actors", "roles")
+        with replica.begin() as connection:
+            connection.execute(TableVersion.__table__.insert(), [
+                {"name": name, "version": version,
+                 "updated_at": datetime.utcnow()}
+                for name, (version, _) in versions.items()])
+            connection.execute(Movie.__table__.insert(),
+                               {"id": 1, "title": "before the write"})
+        local = response_cache.backend
+        response_cache.backend = SharedBackend(LocalRedis(), ttl=30)
+        headers = {"Authorization": 'bearer ' + self.token_producer}
+        try:
+            self.client().patch('/movies/1', json={"title": "moved"},
+                                headers=headers)
+            # the other worker did not write: it reads the replica
+            replica_set.replicas = [Replica(url, {})]
+            replica_set.written_at = None
+            replica_set.checked_at = None
+            res = self.client().get('/movies/1', headers=headers)
+            self.assertEqual(json.loads(res.data)['movies'],
+                             "before the write")
+            replica_set.replicas = []
+            res = self.client().get('/movies/1', headers=headers)
+            self.assertEqual(json.loads(res.data)['movies'], "moved")
+        finally:
+            replica_set.replicas = []
+            response_cache.backend = local
+            replica.dispose()
+
+    # the ndjson header bypasses the cache of the routes adding tags
+    def test_200_ndjson_header_on_tagged_routes(self):
+        for path in ('/movies/1', '/actors/1', '/actors?include=movies'):
+            res = self.client().get(path, headers={
+                "Authorization": 'bearer ' + self.token_assistant,
+                "Accept": "application/x-ndjson"})
+            self.assertEqual(res.status_code, 200, path)
+
+    # Server-Timing header and Prometheus metrics
+    def test_server_timing_and_metrics(self):
+        res = self.client().get('/movies', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 200)
+        timing = res.headers['Server-Timing']
+        for phase in ("auth;dur=", "pool;dur=", "db;dur=", "serialize;dur=",
+                      "total;dur="):
+            self.assertTrue(phase in timing)
+        self.assertTrue('queries"' in timing)
+
+        res = self.client().get('/metrics', headers={
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(res.status_code, 200)
+        body = res.data.decode('utf-8')
+        self.assertTrue('http_request_duration_seconds_count{method="GET",'
+                        'route="/movies",status="200"}' in body)
+        self.assertTrue('db_queries_per_request_bucket{route="/movies"'
+                        in body)
+
+    def test_401_metrics_without_token(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 401)
+
+    # profile of a request asked with the secret header
+    def test_profile_with_secret_header(self):
+        directory = tempfile.mkdtemp()
+        app = create_app()
+        self.assertTrue(init_profiling(app, directory, secret="unit"))
+        headers = {"Authorization": 'bearer ' + self.token_assistant}
+        res = app.test_client().get('/movies', headers=headers)
+        self.assertFalse('X-Profile-Id' in res.headers)
+
+        headers["X-Profile"] = "unit"
+        res = app.test_client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        path = os.path.join(directory, res.headers['X-Profile-Id'])
+        self.assertTrue(pstats.Stats(path + '.pstats').total_calls > 0)
+        with open(path + '.json') as file:
+            profile = json.load(file)
+        self.assertEqual(profile['route'], '/movies')
+        self.assertTrue(len(profile['sql']) > 0)
+
+    def test_profiling_disabled_without_secret_or_rate(self):
+        self.assertFalse(init_profiling(create_app(), tempfile.mkdtemp(),
+                                        secret=None, sample_rate=0))
+
+    # async serving mode (asgi.py)
+    def asgi_get(self, path, headers=None):
+        api = AsyncAPI(self.app)
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': query.encode('utf-8'),
+                 'headers': [(name.lower().encode('latin-1'),
+                              value.encode('latin-1'))
+                             for name, value in (headers or {}).items()]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        async def call():
+            try:
+                await api(scope, receive, send)
+            finally:
+                if api.engine is not None:
+                    await api.engine.dispose()
+
+        asyncio.run(call())
+        start, body = messages
+        return (start['status'],
+                {name.decode('latin-1'): value.decode('latin-1')
+                 for name, value in start['headers']},
+                body['body'])
+
+    def test_200_and_304_async_get_movies(self):
+        headers = {"Authorization": 'bearer ' + self.token_assistant,
+                   "Origin": "http://unit"}
+        status, response_headers, body = self.asgi_get('/movies', headers)
+        self.assertEqual(status, 200)
+        self.assertTrue(len(json.loads(body)['movies']))
+        # the same headers as the flask app
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(
+            {(name.lower(), value) for name, value in res.headers
+             if name.lower().startswith(('access-control-', 'vary'))},
+            {(name, value) for name, value in response_headers.items()
+             if name.startswith(('access-control-', 'vary'))})
+        self.assertEqual({name.lower() for name, _ in res.headers},
+                         set(response_headers))
+        headers['If-None-Match'] = response_headers['etag']
+        status, _, body = self.asgi_get('/movies', headers)
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_async_errors_from_flask_handlers(self):
+        status, _, body = self.asgi_get('/movies')
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body)['success'], False)
+        status, _, body = self.asgi_get('/movies/100000', {
+            "Authorization": 'bearer ' + self.token_assistant})
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['error'], 404)
+
+
+class LocalRedis:
+    """Stand-in of a redis client for the shared cache backend"""
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def smembers(self, key):
+        return self.sets.get(key, set())
+
+    def expire(self, key, ttl):
+        pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.sets.pop(key, None)
+
+
+class SharedBackendTestCase(unittest.TestCase):
+    """This class represents the shared response cache test case"""
+
+    def test_invalidate_only_tagged_entries(self):
+        backend = SharedBackend(LocalRedis(), ttl=30)
+        backend.set('/movies/1', b'movie 1', ['movie:1', 'actor:2'])
+        backend.set('/movies/3', b'movie 3', ['movie:3'])
+        backend.invalidate(['actor:2'])
+        self.assertIsNone(backend.get('/movies/1'))
+        self.assertEqual(backend.get('/movies/3'), b'movie 3')
+        self.assertEqual(backend.stats()['hits'], 1)
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    """This class represents the key store test case"""
+
+    def setUp(self):
+        self.jwks = {"keys": [{"kty": "RSA", "kid": "key1", "use": "sig",
+                               "n": "abc", "e": "AQAB"}]}
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return self.jwks
+
+    def fetch_down(self):
+        self.fetches += 1
+        raise OSError("provider down")
+
+    def test_keys_fetched_once(self):
+        store = JWKSStore(url="https://unit/jwks.json")
+        store.fetch = self.fetch
+        store.start_background_refresh = lambda: None
+        self.assertEqual(store.get_key("key1")["kid"], "key1")
+        self.assertEqual(store.get_key("key1")["kid"], "key1")
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        store = JWKSStore(url="https://unit/jwks.json")
+        store.fetch = self.fetch
+        store.start_background_refresh = lambda: None
+        self.assertIsNone(store.get_key("unknown"))
+        self.assertIsNone(store.get_key("unknown"))
+        self.assertEqual(self.fetches, 1)
+
+    def test_stale_keys_served_when_provider_down(self):
+        store = JWKSStore(url="https://unit/jwks.json", refresh_interval=0,
+                          min_refresh_interval=0)
+        store.load(self.jwks)
+        store.fetch = self.fetch_down
+        store.start_background_refresh = lambda: None
+        self.assertEqual(store.get_key("key1")["kid"], "key1")
+        self.assertTrue(self.fetches >= 1)
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    """This class represents the engine settings test case"""
+
+    def test_pool_options_of_server_database(self):
+        options = engine_options("postgresql://localhost:5432/unit")
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertTrue(options["pool_size"] > 0)
+        self.assertTrue("pool_recycle" in options)
+
+    def test_no_pool_size_for_sqlite(self):
+        self.assertFalse("pool_size" in engine_options("sqlite:///unit.db"))
+
+    def test_async_database_url(self):
+        self.assertEqual(async_database_url("postgresql://localhost/unit"),
+                         "postgresql+asyncpg://localhost/unit")
+        self.assertEqual(
+            async_database_url("postgresql+psycopg2://localhost/unit"),
+            "postgresql+asyncpg://localhost/unit")
+        self.assertEqual(async_database_url("sqlite:///unit.db"),
+                         "sqlite+aiosqlite:///unit.db")
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """This class represents the json serialization test case"""
+
+    def setUp(self):
+        self.data = {
+            "success": True,
+            "movies": [{"id": 1, "title": "Amélie", "release":
+                        datetime(2001, 4, 25, 20, 30, 15, 250000)}],
+            "dates": [date(2011, 11, 11),
+                      datetime(2011, 11, 11, 8, tzinfo=timezone.utc)],
+            1: "int key"}
+
+    def test_create_provider(self):
+        self.assertEqual(create_provider("stdlib").name, "stdlib")
+        with mock.patch.dict(sys.modules, {"orjson": None}):
+            self.assertEqual(create_provider().name, "stdlib")
+            with self.assertRaises(ImportError):
+                create_provider("orjson")
+
+    @unittest.skipUnless(importlib.util.find_spec("orjson"),
+                         "orjson is not installed")
+    def test_same_bytes_with_orjson_and_stdlib(self):
+        self.assertEqual(create_provider("orjson").name, "orjson")
+        self.assertEqual(create_provider("orjson").dumps(self.data),
+                         create_provider("stdlib").dumps(self.data))
+
+    def test_jsonify_arguments(self):
+        with Flask(__name__).app_context():
+            res = jsonify({"id": 1})
+            self.assertEqual(res.mimetype, "application/json")
+            self.assertEqual(res.get_data(), b'{"id":1}\n')
+            self.assertEqual(json.loads(jsonify(1, 2).get_data()), [1, 2])
+            self.assertEqual(json.loads(jsonify(id=1).get_data()),
+                             {"id": 1})
+            with self.assertRaises(TypeError):
+                jsonify({"id": 1}, id=1)
+
+
+class ConditionalTestCase(unittest.TestCase):
+    """This class represents the conditional GET test case"""
+
+    def setUp(self):
+        self.written_at = datetime(2021, 6, 1, 12, 0, 0, 300000)
+        self.versions = {"movies": (3, self.written_at)}
+
+    def test_last_modified_withheld_during_its_second(self):
+        self.assertIsNone(last_modified_of(
+            self.versions, self.written_at + timedelta(milliseconds=500)))
+        self.assertEqual(last_modified_of(
+            self.versions, self.written_at + timedelta(seconds=1)),
+            self.written_at)
+
+    def test_etag_wins_over_if_modified_since(self):
+        later = self.written_at + timedelta(seconds=5)
+        self.assertFalse(not_modified("new", self.written_at,
+                                      parse_etags('W/"old"'), later))
+        self.assertTrue(not_modified("new", self.written_at,
+                                     parse_etags('W/"new"'), None))
+        self.assertTrue(not_modified("new", self.written_at,
+                                     parse_etags(None), later))
+
+
+class CoStarGraphTestCase(unittest.TestCase):
+    """This class represents the co-star graph test case"""
+
+    def setUp(self):
+        # (movie_id, actor_id): 1 and 2 in movie 10, 2 and 3 in movie 11,
+        # 3 and 4 in movie 12, 5 alone in movie 13
+        pairs = [(10, 1), (10, 2), (11, 2), (11, 3), (12, 3), (12, 4),
+                 (13, 5)]
+        self.graph = CoStarGraph()
+        self.graph.actor_movies = build_csr(
+            sorted((actor, movie) for movie, actor in pairs))
+        self.graph.movie_actors = build_csr(sorted(pairs))
+        self.graph.version = 1
+
+    def test_costars(self):
+        self.assertEqual(self.graph.costars(2), [1, 3])
+        self.assertEqual(self.graph.costars(5), [])
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.path(1, 4), ([1, 2, 3, 4], [10, 11, 12]))
+        self.assertEqual(self.graph.path(4, 1), ([4, 3, 2, 1], [12, 11, 10]))
+        self.assertIsNone(self.graph.path(1, 5))
+        self.assertIsNone(self.graph.path(1, 4, max_depth=2))
+
+    def test_patch(self):
+        self.graph.patch(1, 2, [([(13, 1)], [(11, 3)])])
+        self.assertEqual(self.graph.version, 2)
+        self.assertEqual(self.graph.path(1, 5), ([1, 5], [13]))
+        self.assertIsNone(self.graph.path(1, 4))
+
+    def test_patch_from_other_version_marks_stale(self):
+        self.graph.patch(5, 6, [([(13, 1)], [])])
+        self.assertIsNone(self.graph.version)
+
+
+class ReplicaSetTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.urls = ["sqlite:///" + os.path.join(directory, name)
+                     for name in ("primary.db", "replica1.db", "replica2.db")]
+        self.now = datetime.utcnow()
+        for url in self.urls:
+            self.write_version(url, 3, self.now)
+        self.primary = create_engine(self.urls[0])
+        self.replicas = ReplicaSet(
+            self.urls[1:], lambda url: {},
+            lambda connection: TableVersion.versions(connection.execute(
+                TableVersion.current_statement("movies"))),
+            max_lag=5, check_seconds=0)
+
+    def write_version(self, url, version, updated_at):
+        engine = create_engine(url)
+        TableVersion.__table__.create(engine, checkfirst=True)
+        with engine.begin() as connection:
+            connection.execute(TableVersion.__table__.delete())
+            connection.execute(TableVersion.__table__.insert(), {
+                "name": "movies", "version": version,
+                "updated_at": updated_at})
+        engine.dispose()
+
+    def test_replication_lag(self):
+        primary = {"movies": (4, self.now)}
+        self.assertEqual(replication_lag(
+            primary, {"movies": (4, self.now)}, self.now), 0)
+        self.assertEqual(replication_lag(
+            primary, {"movies": (3, self.now - timedelta(seconds=9))},
+            self.now), 9)
+
+    def test_round_robin(self):
+        engines = {self.replicas.choose(self.primary).url.database
+                   for _ in range(4)}
+        self.assertEqual(len(engines), 2)
+
+    def test_lagging_replica_skipped(self):
+        self.write_version(self.urls[0], 4, self.now)
+        self.write_version(self.urls[1], 3, self.now - timedelta(seconds=60))
+        for _ in range(4):
+            self.assertTrue(self.replicas.choose(self.primary).url.database
+                            .endswith("replica2.db"))
+        self.write_version(self.urls[2], 3, self.now - timedelta(seconds=60))
+        self.assertIsNone(self.replicas.choose(self.primary))
+
+    def test_primary_after_write(self):
+        self.replicas.record_write()
+        self.assertIsNone(self.replicas.choose(self.primary))
+
+    def test_dispose_keeps_inherited_connections(self):
+        replica = Replica(self.urls[1], {"poolclass": QueuePool})
+        engine = replica.engine
+        engine.connect().close()
+        inherited = engine.pool
+        replica.dispose()
+        self.assertIsNot(engine.pool, inherited)
+        self.assertEqual(inherited.checkedin(), 1)
+        self.assertEqual(engine.pool.checkedin(), 0)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class represents the request coalescing test case"""
+
+    def setUp(self):
+        self.calls = 0
+
+    def test_concurrent_calls_share_one_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def compute():
+            self.calls += 1
+            release.wait(5)
+            return "body"
+
+        def request():
+            results.append(flights.do("/movies", compute))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        while not flights.running("/movies"):
+            pass
+        followers = [threading.Thread(target=request) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        while flights.stats()["waiting"] < 4:
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(shared for _, shared in results),
+                         [False, True, True, True, True])
+        self.assertFalse(flights.running("/movies"))
+
+    def test_failed_leader_lets_followers_compute(self):
+        flights = SingleFlight()
+        self.assertRaises(ValueError, flights.do, "key", self.fail)
+        self.assertEqual(flights.do("key", lambda: "body"), ("body", False))
+
+    def fail(self):
+        raise ValueError("database down")
+
+    def test_async_concurrent_calls_share_one_result(self):
+        flights = AsyncSingleFlight()
+
+        async def compute():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return "body"
+
+        async def requests():
+            return await asyncio.gather(
+                *[flights.do("/movies", compute) for _ in range(5)])
+
+        results = asyncio.run(requests())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([body for body, _ in results], ["body"] * 5)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+from sqlalchemy import select, update, delete
+
+from models import (db, Movie, Actor, Role, TableVersion, invalidate,
+                    record_roles)
+
+'''
+Single statement writes
+    used by PATCH and DELETE /movies/<id> and /actors/<id>
+    the row is updated (deleted) by id without loading the ORM object:
+        - dialects with RETURNING: one UPDATE (DELETE) ... RETURNING, no
+          row returned means the id does not exist
+        - otherwise: the rowcount of the UPDATE (DELETE) tells the same
+    the version of the written tables is bumped (conditional GET) and
+    the cached responses showing the row are invalidated
+    the caller commits the transaction
+'''
+
+movies = Movie.__table__
+actors = Actor.__table__
+roles = Role.__table__
+
+
+def _returning(connection):
+    return getattr(connection.dialect, 'full_returning', False)
+
+
+'''
+update_movie_row(movie_id, values)
+    returns the short form of the updated movie or None if not found
+    on PostgreSQL the UPDATE ... RETURNING is a CTE joined to the cast
+    names so the whole write is one round trip
+'''
+
+
+def update_movie_row(movie_id, values):
+    connection = db.session.connection()
+    cast = actors.c.name
+    if values and _returning(connection):
+        updated = update(movies).where(movies.c.id == movie_id).values(
+            values).returning(movies.c.id, movies.c.title).cte('updated')
+        rows = connection.execute(
+            select(updated.c.id, updated.c.title, cast).select_from(
+                updated.outerjoin(roles, roles.c.movie_id == updated.c.id)
+                .outerjoin(actors, actors.c.id == roles.c.actor_id))
+            .order_by(roles.c.id)).all()
+    else:
+        if values and not connection.execute(update(movies).where(
+                movies.c.id == movie_id).values(values)).rowcount:
+            return None
+        rows = connection.execute(
+            select(movies.c.id, movies.c.title, cast).select_from(
+                movies.outerjoin(roles, roles.c.movie_id == movies.c.id)
+                .outerjoin(actors, actors.c.id == roles.c.actor_id))
+            .where(movies.c.id == movie_id).order_by(roles.c.id)).all()
+    if not rows:
+        return None
+    if values:
+        TableVersion.bump('movies')
+        invalidate('movies', f'movie:{movie_id}')
+    return {
+        'id': rows[0][0],
+        'name': rows[0][1],
+        'actors': [row[2] for row in rows if row[2] is not None]
+        }
+
+
+'''
+update_actor_row(actor_id, values)
+    returns the short form of the updated actor or None if not found
+'''
+
+
+def update_actor_row(actor_id, values):
+    connection = db.session.connection()
+    where = actors.c.id == actor_id
+    if values and _returning(connection):
+        row = connection.execute(update(actors).where(where).values(
+            values).returning(actors.c.id, actors.c.name)).first()
+    else:
+        if values and not connection.execute(
+                update(actors).where(where).values(values)).rowcount:
+            return None
+        row = connection.execute(
+            select(actors.c.id, actors.c.name).where(where)).first()
+    if row is None:
+        return None
+    if values:
+        TableVersion.bump('actors')
+        invalidate('actors', 'movies', f'actor:{actor_id}')
+    return {
+        'id': row[0],
+        'name': row[1]
+        }
+
+
+'''
+delete_movie_row(movie_id) / delete_actor_row(actor_id)
+    delete the casting links then the row in the same transaction
+    return False if the id does not exist
+'''
+
+
+def delete_movie_row(movie_id):
+    return _delete(movies, roles.c.movie_id, movie_id,
+                   ('movies', f'movie:{movie_id}'))
+
+
+def delete_actor_row(actor_id):
+    return _delete(actors, roles.c.actor_id, actor_id,
+                   ('actors', 'movies', f'actor:{actor_id}'))
+
+
+def _delete(table, role_column, id, tags):
+    connection = db.session.connection()
+    uncast = delete(roles).where(role_column == id)
+    statement = delete(table).where(table.c.id == id)
+    if _returning(connection):
+        pairs = connection.execute(uncast.returning(
+            roles.c.movie_id, roles.c.actor_id)).all()
+        deleted = connection.execute(
+            statement.returning(table.c.id)).first() is not None
+    else:
+        pairs = connection.execute(select(
+            roles.c.movie_id, roles.c.actor_id).where(role_column == id)).all()
+        connection.execute(uncast)
+        deleted = connection.execute(statement).rowcount > 0
+    if deleted:
+        if pairs:
+            TableVersion.bump(table.name, 'roles')
+            record_roles(removed=[tuple(pair) for pair in pairs])
+        else:
+            TableVersion.bump(table.name)
+        invalidate(*tags)
+    return deleted